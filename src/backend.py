@@ -1,120 +1,175 @@
 #!/usr/bin/env python
 
+import os
 import urllib
 from xml.etree import ElementTree
+import xml.parsers.expat
 import logging
+try:
+	import cStringIO as StringIO
+except ImportError:
+	import StringIO
 
 import browser_emu
+from util import coroutines
+import page_cache
 
 
 _moduleLogger = logging.getLogger(__name__)
 
 
+_HOUR = 60 * 60
+_DAY = 24 * _HOUR
+
+
 class Backend(object):
 
-	def __init__(self):
-		self._browser = browser_emu.MozillaEmulator()
+	# How long, in seconds, a cached response is fresh for each API action.
+	# Anything not listed is never cached
+	CACHE_TTLS = {
+		"lds.radio.languages.query": 7 * _DAY,
+		"lds.radio.radiochannels.query": 7 * _DAY,
+		"lds.radio.radiochannels.programming.query": 6 * _HOUR,
+		"lds.radio.conferences.query": _DAY,
+		"lds.radio.conferences.sessions.query": 30 * _DAY,
+		"lds.radio.conferences.sessions.talks.query": 30 * _DAY,
+		"lds.radio.magazines.query": 7 * _DAY,
+		"lds.radio.magazines.issues.query": _DAY,
+		"lds.radio.magazines.issues.articles.query": 30 * _DAY,
+		"lds.radio.scriptures.query": 30 * _DAY,
+		"lds.radio.scriptures.books.query": 30 * _DAY,
+		"lds.radio.scriptures.books.chapters.query": 30 * _DAY,
+	}
+
+	# Cached responses not stored again in this many seconds are purged,
+	# mostly to drop radio programming for long gone days
+	CACHE_PURGE_AGE = 60 * _DAY
+
+	def __init__(self, cachePath = None, retryPolicy = None):
+		self._browser = browser_emu.MozillaEmulator(retryPolicy = retryPolicy)
+		if cachePath is not None:
+			self._cache = page_cache.PageCache(os.path.join(cachePath, "pages"))
+			self._browser.enable_revalidation(os.path.join(cachePath, "validators"))
+		else:
+			self._cache = None
+
+	def close(self):
+		self._browser.close()
+
+	def purge_cache(self):
+		if self._cache is None:
+			return 0
+		removed = self._cache.purge(self.CACHE_PURGE_AGE)
+		removed += self._browser.purge_revalidation(self.CACHE_PURGE_AGE)
+		return removed
+
+	def get_cache_stats(self):
+		if self._cache is None:
+			return {}
+		return self._cache.get_stats()
 
 	def get_languages(self):
-		tree = self._get_page_with_validation(
+		return self._get_list_with_validation(
+			"languages",
+			["name"],
 			action="lds.radio.languages.query",
 		)
-		languages = tree.find("languages")
-		return self._process_list(languages, ["name"])
 
 	def get_radio_channels(self):
-		tree = self._get_page_with_validation(
+		return self._get_list_with_validation(
+			"channels",
+			["description", "url", "port"],
 			action="lds.radio.radiochannels.query",
 		)
-		channels = tree.find("channels")
-		return self._process_list(channels, ["description", "url", "port"])
 
 	def get_radio_channel_programming(self, chanId, date=None):
 		if date is not None:
-			tree = self._get_page_with_validation(
+			return self._get_list_with_validation(
+				"programs",
+				["date", "time", "title", "shortdescription", "artist"],
 				action="lds.radio.radiochannels.programming.query",
 				channelID=chanId,
 				date=date,
 			)
 		else:
-			tree = self._get_page_with_validation(
+			return self._get_list_with_validation(
+				"programs",
+				["date", "time", "title", "shortdescription", "artist"],
 				action="lds.radio.radiochannels.programming.query",
 				channelID=chanId,
 			)
-		programs = tree.find("programs")
-		return self._process_list(programs, ["date", "time", "title", "shortdescription", "artist"])
 
 	def get_conferences(self, langId):
-		tree = self._get_page_with_validation(
+		return self._get_list_with_validation(
+			"conferences",
+			["title", "full_title", "month", "year"],
 			action="lds.radio.conferences.query",
 			languageID=langId,
 		)
-		conferences = tree.find("conferences")
-		return self._process_list(conferences, ["title", "full_title", "month", "year"])
 
 	def get_conference_sessions(self, confId):
-		tree = self._get_page_with_validation(
+		return self._get_list_with_validation(
+			"sessions",
+			["title", "short_title", "order"],
 			action="lds.radio.conferences.sessions.query",
 			conferenceID=confId,
 		)
-		items = tree.find("sessions")
-		return self._process_list(items, ["title", "short_title", "order"])
 
 	def get_conference_talks(self, sessionId):
-		tree = self._get_page_with_validation(
+		return self._get_list_with_validation(
+			"talks",
+			["title", "order", "url", "speaker"],
 			action="lds.radio.conferences.sessions.talks.query",
 			sessionID=sessionId,
 		)
-		items = tree.find("talks")
-		return self._process_list(items, ["title", "order", "url", "speaker"])
 
 	def get_magazines(self, langId):
-		tree = self._get_page_with_validation(
+		return self._get_list_with_validation(
+			"magazines",
+			["title"],
 			action="lds.radio.magazines.query",
 			languageID=langId,
 		)
-		magazines = tree.find("magazines")
-		return self._process_list(magazines, ["title"])
 
 	def get_magazine_issues(self, magId):
-		tree = self._get_page_with_validation(
+		return self._get_list_with_validation(
+			"issues",
+			["title", "year", "month", "pictureURL"],
 			action="lds.radio.magazines.issues.query",
 			magazineID=magId,
 		)
-		items = tree.find("issues")
-		return self._process_list(items, ["title", "year", "month", "pictureURL"])
 
 	def get_magazine_articles(self, issueId):
-		tree = self._get_page_with_validation(
+		return self._get_list_with_validation(
+			"articles",
+			["title", "author", "url"],
 			action="lds.radio.magazines.issues.articles.query",
 			issueID=issueId,
 		)
-		items = tree.find("articles")
-		return self._process_list(items, ["title", "author", "url"])
 
 	def get_scriptures(self, langId):
-		tree = self._get_page_with_validation(
+		return self._get_list_with_validation(
+			"scriptures",
+			["title"],
 			action="lds.radio.scriptures.query",
 			languageID=langId,
 		)
-		scriptures = tree.find("scriptures")
-		return self._process_list(scriptures, ["title"])
 
 	def get_scripture_books(self, scriptId):
-		tree = self._get_page_with_validation(
+		return self._get_list_with_validation(
+			"books",
+			["title"],
 			action="lds.radio.scriptures.books.query",
 			scriptureID=scriptId,
 		)
-		items = tree.find("books")
-		return self._process_list(items, ["title"])
 
 	def get_scripture_chapters(self, bookId):
-		tree = self._get_page_with_validation(
+		return self._get_list_with_validation(
+			"chapters",
+			["title", "url"],
 			action="lds.radio.scriptures.books.chapters.query",
 			bookID=bookId,
 		)
-		items = tree.find("chapters")
-		return self._process_list(items, ["title", "url"])
 
 	CONFERENCE_SEARCH = 1
 	MAGAZINE_SEARCH = 2
@@ -131,9 +186,68 @@ class Backend(object):
 		return tree
 
 	def _get_page_with_validation(self, **params):
-		encodedParams = urllib.urlencode(params)
+		return self._fetch(self._parse_page, params)
+
+	def _get_list_with_validation(self, listTag, elements, **params):
+		return self._fetch(
+			lambda f: self._parse_list(f, listTag, elements),
+			params,
+		)
+
+	def _fetch(self, parse, params):
+		encodedParams = urllib.urlencode(sorted(params.iteritems()))
 		url = "http://tech.lds.org/radio?%s" % encodedParams
-		page = self._browser.download(url)
+		ttl = self.CACHE_TTLS.get(params["action"], 0)
+		useCache = self._cache is not None and 0 < ttl
+
+		page = None
+		cachedBody = None
+		if useCache:
+			page = self._cache.get(encodedParams, ttl)
+			if page is None:
+				# Outdated, but the server may still say it is current
+				cachedBody = self._cache.peek(encodedParams)
+		if page is not None:
+			try:
+				return parse(StringIO.StringIO(page))
+			except Exception:
+				_moduleLogger.exception("Discarding bad cache entry for %s" % url)
+
+		writer = None
+		isComplete = []
+		try:
+			if useCache:
+				writer = self._cache.create_writer(encodedParams)
+			f = self._browser.stream(
+				url,
+				sink = writer,
+				on_complete = lambda: isComplete.append(True),
+				cachedBody = cachedBody,
+			)
+			try:
+				result = parse(f)
+			finally:
+				f.close()
+		except Exception:
+			if writer is not None:
+				writer.abort()
+			if not useCache:
+				raise
+			page = self._cache.get_stale(encodedParams)
+			if page is None:
+				raise
+			_moduleLogger.exception("Download failed, falling back to stale copy of %s" % url)
+			return parse(StringIO.StringIO(page))
+
+		if writer is not None:
+			if isComplete:
+				writer.commit()
+			else:
+				writer.abort()
+		return result
+
+	def _parse_page(self, f):
+		page = f.read()
 		if not page:
 			raise RuntimeError("Blank page")
 		tree = ElementTree.fromstring(page)
@@ -148,18 +262,212 @@ class Backend(object):
 
 		return tree
 
-	def _process_list(self, tree, elements):
-		for item in tree.getchildren():
-			data = {"id": item.attrib["ID"]}
-			for element in elements:
-				data[element] = item.find(element).text
-			yield data
+	def _parse_list(self, f, listTag, elements):
+		"""
+		Parse the items of listTag as the page streams in, never building the
+		full tree
+		"""
+		parser = _ListParser(listTag, elements)
+		try:
+			coroutines.expat_parse(f, parser)
+		except xml.parsers.expat.ExpatError:
+			if not parser.has_started:
+				raise RuntimeError("Blank page")
+			raise
+		return parser.finish()
+
+
+class Record(object):
+	"""
+	Fixed-shape catalog item with dict-style access, standing in for a
+	per-item dict.  Use record_type() to get the class for a given shape
+
+	>>> Talk = record_type(["id", "title", "speaker"])
+	>>> talk = Talk("5", "Faith", None)
+	>>> talk["title"], talk.get("speaker", ""), "url" in talk
+	('Faith', None, False)
+	>>> sorted(talk.items())
+	[('id', '5'), ('speaker', None), ('title', 'Faith')]
+	"""
+
+	__slots__ = ()
+	_fields = ()
+
+	def __init__(self, *values):
+		if len(values) != len(self._fields):
+			raise TypeError("Expected %d values, got %d" % (len(self._fields), len(values)))
+		for field, value in zip(self._fields, values):
+			setattr(self, field, value)
+
+	def __getitem__(self, key):
+		if key not in self._fields:
+			raise KeyError(key)
+		return getattr(self, key)
+
+	def get(self, key, default = None):
+		if key not in self._fields:
+			return default
+		return getattr(self, key)
+
+	def __contains__(self, key):
+		return key in self._fields
+
+	def __iter__(self):
+		return iter(self._fields)
+
+	def __len__(self):
+		return len(self._fields)
+
+	def keys(self):
+		return list(self._fields)
+
+	def values(self):
+		return [getattr(self, field) for field in self._fields]
+
+	def items(self):
+		return zip(self._fields, self.values())
+
+	def __eq__(self, other):
+		return isinstance(other, Record) and self.items() == other.items()
+
+	def __ne__(self, other):
+		return not self.__eq__(other)
+
+	def __reduce__(self):
+		return _make_record, (self._fields, tuple(self.values()))
+
+	def __repr__(self):
+		return "%s(%s)" % (
+			type(self).__name__,
+			", ".join("%s=%r" % item for item in self.items()),
+		)
+
+
+_RECORD_TYPES = {}
+
+
+def record_type(fields):
+	fields = tuple(fields)
+	try:
+		return _RECORD_TYPES[fields]
+	except KeyError:
+		recordType = type("Record_%s" % "_".join(fields), (Record, ), {
+			"__slots__": fields,
+			"_fields": fields,
+		})
+		return _RECORD_TYPES.setdefault(fields, recordType)
 
 
+def _make_record(fields, values):
+	return record_type(fields)(*values)
+
+
+def _fixtext(text):
+	# Mirror ElementTree, plain str for ASCII and unicode otherwise
+	try:
+		text.decode("ascii")
+	except UnicodeError:
+		return text.decode("utf-8")
+	else:
+		return text
+
+
+class _ListParser(object):
+	"""
+	expat_parse target turning the children of listTag into records as their
+	closing tags arrive
+	"""
+
+	def __init__(self, listTag, elements):
+		self._listTag = listTag
+		self._elements = elements
+		self._recordType = record_type(["id"] + list(elements))
+		self._fieldIndices = dict(
+			(field, i)
+			for i, field in enumerate(self._recordType._fields)
+		)
+		self._items = []
+		self._depth = 0
+		self._isError = False
+		self._hasResults = False
+		self._hasList = False
+		self._inList = False
+		self._item = None
+		self._text = None
+
+	@property
+	def has_started(self):
+		return self._isError or self._hasResults or self._hasList or 0 < self._depth
+
+	def send(self, event):
+		kind, value = event
+		if kind == "start":
+			self._depth += 1
+			self._on_start(*value)
+		elif kind == "end":
+			self._on_end(value)
+			self._depth -= 1
+		elif kind == "text":
+			if self._text is not None:
+				self._text.append(value)
+
+	def finish(self):
+		if self._isError:
+			raise RuntimeError("Unknown API error")
+		if not self._hasResults:
+			raise RuntimeError("Could not determine radio languages")
+		if not self._hasList:
+			raise RuntimeError("Missing %s" % self._listTag)
+		return self._items
+
+	def _on_start(self, name, attrs):
+		depth = self._depth
+		if depth == 1:
+			self._isError = name == "apiresults"
+		elif self._isError:
+			if depth == 2 and name == "ErrorDescription":
+				self._text = []
+		elif depth == 2:
+			if name == "apiresults":
+				if not attrs.get("success"):
+					raise RuntimeError("Could not determine radio languages")
+				self._hasResults = True
+			elif name == self._listTag and not self._hasList:
+				self._hasList = True
+				self._inList = True
+		elif self._inList:
+			if depth == 3:
+				self._item = [None] * len(self._fieldIndices)
+				self._item[0] = attrs["ID"]
+			elif depth == 4 and name in self._elements:
+				self._text = []
+			else:
+				self._text = None
+
+	def _on_end(self, name):
+		depth = self._depth
+		if self._isError:
+			if depth == 2 and name == "ErrorDescription":
+				raise RuntimeError(_fixtext("".join(self._text)))
+		elif self._inList:
+			if depth == 2:
+				self._inList = False
+			elif depth == 3:
+				self._items.append(self._recordType(*self._item))
+				self._item = None
+			elif depth == 4 and self._text is not None:
+				if self._text:
+					self._item[self._fieldIndices[name]] = _fixtext("".join(self._text))
+				self._text = None
+
 if __name__ == "__main__":
+	import doctest
+	doctest.testmod()
+
 	b = Backend()
 
 	print list(b.get_languages())
+	print b.get_cache_stats()
 
 	if False:
 		channels = list(b.get_radio_channels())
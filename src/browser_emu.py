@@ -25,12 +25,28 @@ Optional steps:
 	- The "encode_multipart_formdata" function can be used alone to create POST data from a list of field values and files
 """
 
+from __future__ import with_statement
+
+import os
+import time
+import random
+import zlib
+import threading
+import urllib
 import urllib2
+import httplib
 import cookielib
+import cPickle
 import logging
+try:
+	import cStringIO as StringIO
+except ImportError:
+	import StringIO
 
 import socket
 
+import util.io as io_utils
+
 
 _moduleLogger = logging.getLogger("browser_emu")
 socket.setdefaulttimeout(20)
@@ -38,16 +54,46 @@ socket.setdefaulttimeout(20)
 
 class MozillaEmulator(object):
 
-	def __init__(self, trycount = 1):
+	CHUNK_SIZE = 16 * 1024
+
+	def __init__(self, trycount = 1, retryPolicy = None):
 		"""Create a new MozillaEmulator object.
 
 		@param trycount: The download() method will retry the operation if it
 		fails. You can specify -1 for infinite retrying.  A value of 0 means no
-		retrying. A value of 1 means one retry. etc."""
+		retrying. A value of 1 means one retry. etc.
+		@param retryPolicy: RetryPolicy deciding when and how long to wait
+		before retrying, defaults to one built from trycount"""
 		self.debug = False
 		self.trycount = trycount
+		if retryPolicy is None:
+			retryPolicy = RetryPolicy(maxRetries = trycount)
+		self.retryPolicy = retryPolicy
 		self._cookies = cookielib.LWPCookieJar()
 		self._loadedFromCookies = False
+		self._validators = None
+		self._connections = ConnectionPool()
+
+	def enable_revalidation(self, path = None):
+		"""Remember ETag/Last-Modified of GET responses and send them back on
+		the next request for the same URL that comes with the body the caller
+		already has, reusing that body on a 304.
+
+		@param path: Directory to persist validators in, None to keep them in
+			memory only"""
+		self._validators = ValidatorStore(path)
+
+	def close(self):
+		"""Close the connections kept open for reuse"""
+		self._connections.close_all()
+
+	def purge_revalidation(self, maxAge):
+		"""Forget validators that haven't been updated in maxAge seconds
+
+		@returns Number of validators removed"""
+		if self._validators is None:
+			return 0
+		return self._validators.purge(maxAge)
 
 	def load_cookies(self, path):
 		assert not self._loadedFromCookies, "Load cookies only once"
@@ -78,7 +124,7 @@ class MozillaEmulator(object):
 
 	def download(self, url,
 			postdata = None, extraheaders = None, forbidRedirect = False,
-			trycount = None, only_head = False,
+			trycount = None, only_head = False, cachedBody = None,
 		):
 		"""Download an URL with GET or POST methods.
 
@@ -89,19 +135,122 @@ class MozillaEmulator(object):
 			HTTP 301 and 302 redirects.
 		@param trycount: Specify the maximum number of retries here.
 			0 means no retry on error. Using -1 means infinite retring.
-			None means the default value (that is self.trycount).
+			None means the default value (that is self.retryPolicy).
 		@param only_head: Create the openerdirector and return it. In other
 			words, this will not retrieve any content except HTTP headers.
+		@param cachedBody: A previously downloaded body for this URL, with
+			revalidation enabled it is returned if the server says it is
+			still current
 
 		@return: The raw HTML page data
 		"""
 		_moduleLogger.debug("Performing download of %s" % url)
 
+		retryPolicy = self._get_retry_policy(trycount)
+		revalidate = self._validators is not None and postdata is None and not only_head
+
+		openerdirector = self._open(
+			url, postdata, extraheaders, forbidRedirect, retryPolicy,
+			cachedBody if revalidate else None,
+		)
+		if only_head:
+			return openerdirector
+		if openerdirector is None:
+			return cachedBody
+
+		data = self._read(openerdirector)
+		if revalidate:
+			self._validators.update(url, openerdirector.info(), io_utils.md5(data).hexdigest())
+		return data
+
+	def stream(self, url,
+			extraheaders = None, trycount = None,
+			sink = None, on_complete = None, cachedBody = None,
+		):
+		"""GET an URL, leaving the body to be read incrementally.
+
+		@param sink: File-like object each chunk of the body is written to as
+			it is read from the returned object
+		@param on_complete: Called once the whole body has been read
+		@param cachedBody: A previously downloaded body for this URL, with
+			revalidation enabled it is used if the server says it is still
+			current
+
+		@return: A file-like object for the body
+		"""
+		_moduleLogger.debug("Performing streamed download of %s" % url)
+
+		retryPolicy = self._get_retry_policy(trycount)
+		revalidate = self._validators is not None
+
+		openerdirector = self._open(
+			url, None, extraheaders, False, retryPolicy,
+			cachedBody if revalidate else None,
+		)
+		if openerdirector is None:
+			openerdirector = StringIO.StringIO(cachedBody)
+			revalidate = False
+		elif not revalidate and sink is None and on_complete is None:
+			return openerdirector
+
+		def on_recorded(digest):
+			if revalidate:
+				self._validators.update(url, openerdirector.info(), digest)
+			if on_complete is not None:
+				on_complete()
+		return _RecordingReader(openerdirector, sink, on_recorded)
+
+	def download_to(self, url, f, on_progress = None, extraheaders = None, trycount = None):
+		"""GET an URL, writing the body out a chunk at a time as it arrives.
+
+		@param f: File-like object to write to, or a callable taking each chunk
+		@param on_progress: Called after each chunk with (bytesRead, bytesTotal,
+			bytesPerSecond), bytesTotal is None when the server didn't say
+
+		@return: The number of bytes written
+		"""
+		_moduleLogger.debug("Performing chunked download of %s" % url)
+
+		if callable(f):
+			write = f
+		else:
+			write = f.write
+		retryPolicy = self._get_retry_policy(trycount)
+
+		openerdirector = self._open(
+			url, None, extraheaders, False, retryPolicy, None
+		)
+		size = 0
+		for chunk in self._read_chunks(openerdirector, on_progress):
+			write(chunk)
+			size += len(chunk)
+		return size
+
+	def _get_retry_policy(self, trycount):
+		if trycount is None:
+			return self.retryPolicy
+		return self.retryPolicy.copy(maxRetries = trycount)
+
+	def _open(self, url, postdata, extraheaders, forbidRedirect, retryPolicy, cachedBody):
+		"""
+		@param cachedBody: Body to revalidate, None to always download
+		@returns openerdirector or None when cachedBody is still current
+		"""
 		if extraheaders is None:
 			extraheaders = {}
-		if trycount is None:
-			trycount = self.trycount
 		cnt = 0
+		startTime = time.time()
+
+		validated = None
+		if cachedBody is not None:
+			validated = self._validators.get(url, cachedBody)
+			if validated is not None:
+				etag, lastModified = validated
+				extraheaders = dict(extraheaders)
+				if etag is not None:
+					extraheaders["If-None-Match"] = etag
+				if lastModified is not None:
+					extraheaders["If-Modified-Since"] = lastModified
 
 		while True:
 			try:
@@ -112,18 +261,25 @@ class MozillaEmulator(object):
 					_moduleLogger.info("%r - %r" % (openerdirector.code, openerdirector.msg))
 					_moduleLogger.info("%r" % (openerdirector.headers))
 				self._cookies.extract_cookies(openerdirector, req)
-				if only_head:
-					return openerdirector
-
-				return self._read(openerdirector, trycount)
+				encoding = openerdirector.info().getheader("Content-Encoding")
+				if encoding in _DecodingReader.ENCODINGS:
+					openerdirector = _DecodingReader(openerdirector, encoding)
+				return openerdirector
 			except urllib2.URLError, e:
+				if isinstance(e, urllib2.HTTPError):
+					_discard_body(e)
+				if isinstance(e, urllib2.HTTPError) and e.code == 304 and validated is not None:
+					_moduleLogger.debug("Not modified: %s" % url)
+					return None
 				_moduleLogger.debug("%s: %s" % (e, url))
 				cnt += 1
-				if (-1 < trycount) and (trycount < cnt):
+				delay = retryPolicy.get_delay(cnt, time.time() - startTime, e)
+				if delay is None:
 					raise
 
 			# Retry :-)
-			_moduleLogger.debug("MozillaEmulator: urllib2.URLError, retrying %d" % cnt)
+			_moduleLogger.debug("MozillaEmulator: urllib2.URLError, retrying %d in %.1fs" % (cnt, delay))
+			time.sleep(delay)
 
 	def _build_opener(self, url, postdata = None, extraheaders = None, forbidRedirect = False):
 		if extraheaders is None:
@@ -133,6 +289,7 @@ class MozillaEmulator(object):
 			'Accept': 'text/xml,application/xml,application/xhtml+xml,text/html;q=0.9,text/plain;q=0.8,image/png',
 			'Accept-Language': 'en,en-us;q=0.5',
 			'Accept-Charset': 'ISO-8859-1,utf-8;q=0.7,*;q=0.7',
+			'Accept-Encoding': ', '.join(_DecodingReader.ENCODINGS),
 		}
 		for key, value in extraheaders.iteritems():
 			txheaders[key] = value
@@ -145,8 +302,8 @@ class MozillaEmulator(object):
 			redirector = urllib2.HTTPRedirectHandler()
 			#_moduleLogger.info("Redirection enabled")
 
-		http_handler = urllib2.HTTPHandler(debuglevel=self.debug)
-		https_handler = urllib2.HTTPSHandler(debuglevel=self.debug)
+		http_handler = KeepAliveHTTPHandler(self._connections, debuglevel=self.debug)
+		https_handler = KeepAliveHTTPSHandler(self._connections, debuglevel=self.debug)
 
 		u = urllib2.build_opener(
 			http_handler,
@@ -162,27 +319,468 @@ class MozillaEmulator(object):
 			req.add_data(postdata)
 		return (req, u)
 
-	def _read(self, openerdirector, trycount):
-		chunks = []
+	def _read(self, openerdirector):
+		return "".join(self._read_chunks(openerdirector))
 
-		chunk = openerdirector.read()
-		chunks.append(chunk)
-		#while chunk and cnt < trycount:
-		#	time.sleep(1)
-		#	cnt += 1
-		#	chunk = openerdirector.read()
-		#	chunks.append(chunk)
-
-		data = "".join(chunks)
+	def _read_chunks(self, openerdirector, on_progress = None):
+		info = openerdirector.info()
+		if "Content-Length" in info:
+			total = int(info["Content-Length"])
+		else:
+			total = None
 
-		if "Content-Length" in openerdirector.info():
-			assert len(data) == int(openerdirector.info()["Content-Length"]), "The packet header promised %s of data but only was able to read %s of data" % (
-				openerdirector.info()["Content-Length"],
-				len(data),
+		received = 0
+		startTime = time.time()
+		while True:
+			chunk = openerdirector.read(self.CHUNK_SIZE)
+			if not chunk:
+				break
+			# Progress and Content-Length are in terms of bytes on the wire
+			received = getattr(openerdirector, "rawBytesRead", received + len(chunk))
+			if on_progress is not None:
+				elapsed = time.time() - startTime
+				if 0 < elapsed:
+					rate = received / elapsed
+				else:
+					rate = 0.0
+				on_progress(received, total, rate)
+			yield chunk
+
+		if total is not None:
+			assert received == total, "The packet header promised %s of data but only was able to read %s of data" % (
+				total,
+				received,
 			)
 
+
+def _discard_body(response, limit = 64 * 1024):
+	"""Read off a small unwanted body (say of an HTTPError) so the connection
+	can go back to the pool, anything bigger just gets the connection closed"""
+	if getattr(response, "fp", None) is None:
+		return
+	try:
+		response.read(limit)
+		response.close()
+	except (socket.error, httplib.HTTPException, ValueError):
+		pass
+
+
+class RetryPolicy(object):
+	"""Exponential backoff with jitter between retries of a failed request"""
+
+	# Status codes worth another try, anything else is the server's final word
+	RETRY_STATUS_CODES = (408, 500, 502, 503, 504)
+
+	def __init__(self,
+		maxRetries = 3, baseDelay = 0.5, maxDelay = 30, maxElapsed = 60,
+		jitter = 0.5, retryStatusCodes = None,
+	):
+		"""
+		@param maxRetries: -1 for no limit other than maxElapsed
+		@param baseDelay: Seconds to wait before the first retry, doubling after that
+		@param maxDelay: Cap on the wait between any two attempts
+		@param maxElapsed: Give up rather than retry past this many seconds
+			since the first attempt, None for no limit
+		@param jitter: Fraction of each delay to randomly shave off, so
+			clients that failed together don't retry together
+		"""
+		self.maxRetries = maxRetries
+		self.baseDelay = baseDelay
+		self.maxDelay = maxDelay
+		self.maxElapsed = maxElapsed
+		self.jitter = jitter
+		if retryStatusCodes is None:
+			retryStatusCodes = self.RETRY_STATUS_CODES
+		self.retryStatusCodes = retryStatusCodes
+
+	def copy(self, **kwds):
+		settings = {
+			"maxRetries": self.maxRetries,
+			"baseDelay": self.baseDelay,
+			"maxDelay": self.maxDelay,
+			"maxElapsed": self.maxElapsed,
+			"jitter": self.jitter,
+			"retryStatusCodes": self.retryStatusCodes,
+		}
+		settings.update(kwds)
+		return RetryPolicy(**settings)
+
+	def get_delay(self, attempt, elapsed, error):
+		"""
+		@param attempt: Number of the retry being considered, starting at 1
+		@param elapsed: Seconds since the first attempt started
+		@returns Seconds to wait before retrying or None to give up
+		"""
+		if -1 < self.maxRetries and self.maxRetries < attempt:
+			return None
+
+		delay = min(self.maxDelay, self.baseDelay * 2 ** (attempt - 1))
+		delay -= delay * self.jitter * random.random()
+
+		if isinstance(error, urllib2.HTTPError):
+			if error.code not in self.retryStatusCodes:
+				return None
+			retryAfter = _parse_retry_after(error)
+			if retryAfter is not None:
+				if self.maxDelay < retryAfter:
+					return None
+				delay = max(delay, retryAfter)
+
+		if self.maxElapsed is not None and self.maxElapsed < elapsed + delay:
+			return None
+		return delay
+
+
+def _parse_retry_after(error):
+	try:
+		return float(error.info().getheader("Retry-After"))
+	except (AttributeError, TypeError, ValueError):
+		return None
+
+
+class _DecodingReader(object):
+	"""Inflates a gzip or deflate Content-Encoding as the body is read"""
+
+	ENCODINGS = ("gzip", "deflate")
+
+	def __init__(self, f, encoding):
+		self._f = f
+		if encoding == "gzip":
+			self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+			self._maybeRaw = False
+		else:
+			# Some servers send raw deflate data without the zlib wrapper
+			self._decompressor = zlib.decompressobj()
+			self._maybeRaw = True
+		self._buffer = []
+		self._bufferSize = 0
+		self._isEof = False
+		self.rawBytesRead = 0
+
+	def read(self, size = -1):
+		if size is None:
+			size = -1
+		while not self._isEof and (size < 0 or self._bufferSize < size):
+			data = self._f.read(MozillaEmulator.CHUNK_SIZE)
+			if data:
+				self.rawBytesRead += len(data)
+				self._append(self._decompress(data))
+			else:
+				self._append(self._decompressor.flush())
+				self._isEof = True
+
+		data = "".join(self._buffer)
+		if 0 <= size:
+			data, remainder = data[:size], data[size:]
+		else:
+			remainder = ""
+		self._buffer = [remainder]
+		self._bufferSize = len(remainder)
+		return data
+
+	def close(self):
+		self._f.close()
+
+	def __getattr__(self, name):
+		return getattr(self._f, name)
+
+	def _append(self, data):
+		if data:
+			self._buffer.append(data)
+			self._bufferSize += len(data)
+
+	def _decompress(self, data):
+		if not self._maybeRaw:
+			return self._decompressor.decompress(data)
+
+		self._maybeRaw = False
+		try:
+			return self._decompressor.decompress(data)
+		except zlib.error:
+			self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+			return self._decompressor.decompress(data)
+
+
+class _RecordingReader(object):
+	"""Passes reads through, copying each chunk to sink and reporting the
+	digest of the body once it is exhausted"""
+
+	def __init__(self, f, sink, on_complete):
+		self._f = f
+		self._sink = sink
+		self._on_complete = on_complete
+		self._digest = io_utils.md5()
+
+	def read(self, size = -1):
+		data = self._f.read(size)
+		if self._digest is None:
+			return data
+		if data:
+			self._digest.update(data)
+			if self._sink is not None:
+				self._sink.write(data)
+		if not data or size is None or size < 0:
+			digest = self._digest.hexdigest()
+			self._digest = None
+			self._on_complete(digest)
+		return data
+
+	def close(self):
+		self._f.close()
+
+	def info(self):
+		return self._f.info()
+
+
+class ValidatorStore(object):
+	"""Cache validators of responses, keyed by URL.  Bodies are left to the
+	caller, a digest of the body makes sure the validators are only used
+	with the body they came with"""
+
+	def __init__(self, path = None):
+		self._path = path
+		self._memory = {}
+		self._lock = threading.Lock()
+
+		if self._path is not None:
+			io_utils.makedirs(self._path)
+
+	def get(self, url, body):
+		"""
+		@returns (etag, lastModified) for the URL if they were stored along
+			with body, else None
+		"""
+		if self._path is None:
+			with self._lock:
+				stored = self._memory.get(url, None)
+		else:
+			try:
+				with open(self._url_to_path(url), "rb") as f:
+					storedUrl, stored = cPickle.load(f)
+			except (IOError, EOFError, cPickle.UnpicklingError, ValueError):
+				return None
+			if storedUrl != url:
+				return None
+
+		if stored is None:
+			return None
+		etag, lastModified, digest = stored
+		if digest != io_utils.md5(body).hexdigest():
+			return None
+		return etag, lastModified
+
+	def update(self, url, headers, digest):
+		"""
+		@param digest: md5 hexdigest of the body the headers came with
+		"""
+		etag = headers.getheader("ETag")
+		lastModified = headers.getheader("Last-Modified")
+		if etag is None and lastModified is None:
+			return
+		validated = etag, lastModified, digest
+
+		if self._path is None:
+			with self._lock:
+				self._memory[url] = validated
+			return
+
+		data = cPickle.dumps((url, validated), cPickle.HIGHEST_PROTOCOL)
+		try:
+			io_utils.write_atomically(self._url_to_path(url), data)
+		except (OSError, IOError):
+			_moduleLogger.exception("Could not save validators for %s" % url)
+
+	def purge(self, maxAge):
+		"""
+		@returns Number of validators removed
+		"""
+		if self._path is None:
+			return 0
+		return io_utils.purge_older_than(self._path, maxAge)
+
+	def _url_to_path(self, url):
+		return os.path.join(self._path, io_utils.md5(url).hexdigest())
+
+
+class ConnectionPool(object):
+	"""Idle HTTP(S) connections kept open for reuse, per host"""
+
+	def __init__(self, maxPerHost = 4, maxIdle = 8, idleTimeout = 30):
+		self._maxPerHost = maxPerHost
+		self._maxIdle = maxIdle
+		self._idleTimeout = idleTimeout
+		self._idle = {}
+		self._lock = threading.Lock()
+
+	def acquire(self, scheme, host, connectionClass):
+		"""
+		@returns (connection, isReused)
+		"""
+		key = scheme, host
+		with self._lock:
+			self._evict_expired()
+			connections = self._idle.get(key, [])
+			if connections:
+				connection, lastUsed = connections.pop()
+				if not connections:
+					del self._idle[key]
+				return connection, True
+		return connectionClass(host), False
+
+	def release(self, scheme, host, connection):
+		key = scheme, host
+		with self._lock:
+			self._evict_expired()
+			connections = self._idle.setdefault(key, [])
+			connections.append((connection, time.time()))
+			if self._maxPerHost < len(connections):
+				oldConnection, lastUsed = connections.pop(0)
+				oldConnection.close()
+			while self._maxIdle < self._idle_count():
+				self._evict_oldest()
+
+	def close_all(self):
+		with self._lock:
+			for connections in self._idle.itervalues():
+				for connection, lastUsed in connections:
+					connection.close()
+			self._idle.clear()
+
+	def _idle_count(self):
+		return sum(len(connections) for connections in self._idle.itervalues())
+
+	def _evict_expired(self):
+		oldest = time.time() - self._idleTimeout
+		for key, connections in self._idle.items():
+			fresh = []
+			for connection, lastUsed in connections:
+				if lastUsed < oldest:
+					connection.close()
+				else:
+					fresh.append((connection, lastUsed))
+			if fresh:
+				self._idle[key] = fresh
+			else:
+				del self._idle[key]
+
+	def _evict_oldest(self):
+		oldestKey = min(
+			self._idle.iterkeys(),
+			key=lambda key: self._idle[key][0][1],
+		)
+		connections = self._idle[oldestKey]
+		connection, lastUsed = connections.pop(0)
+		connection.close()
+		if not connections:
+			del self._idle[oldestKey]
+
+
+class _PooledResponse(object):
+	"""Hands the connection back to the pool once the body is drained"""
+
+	def __init__(self, response, on_drained, on_abandoned):
+		self._response = response
+		self._on_drained = on_drained
+		self._on_abandoned = on_abandoned
+		self._isDone = False
+		self._check_drained()
+
+	def read(self, amt = None):
+		if self._isDone:
+			return ""
+		data = self._response.read(amt)
+		self._check_drained()
 		return data
 
+	recv = read
+
+	def close(self):
+		if self._isDone:
+			return
+		self._isDone = True
+		self._response.close()
+		self._on_abandoned()
+
+	def _check_drained(self):
+		if self._isDone:
+			return
+		# httplib never closes a response it knows has no body (304, HEAD,
+		# Content-Length: 0) as reading nothing doesn't count as the end, and
+		# the connection refuses the next request until it is
+		if self._response.length == 0:
+			self._response.close()
+		if self._response.isclosed():
+			self._isDone = True
+			self._on_drained()
+
+
+class _KeepAliveMixin(object):
+
+	_IDEMPOTENT_METHODS = ("GET", "HEAD")
+
+	def _open_pooled(self, scheme, connectionClass, req):
+		host = req.get_host()
+		if not host:
+			raise urllib2.URLError("no host given")
+
+		headers = dict(req.unredirected_hdrs)
+		headers.update(dict(
+			(k, v) for k, v in req.headers.items()
+			if k not in headers
+		))
+		headers["Connection"] = "keep-alive"
+		headers = dict(
+			(name.title(), val) for name, val in headers.items()
+		)
+
+		while True:
+			connection, isReused = self._pool.acquire(scheme, host, connectionClass)
+			connection.set_debuglevel(self._debuglevel)
+			try:
+				connection.request(req.get_method(), req.get_selector(), req.get_data(), headers)
+				response = connection.getresponse()
+			except (socket.error, httplib.HTTPException), e:
+				connection.close()
+				if isReused and req.get_method() in self._IDEMPOTENT_METHODS:
+					# Server most likely dropped the idle connection
+					continue
+				raise urllib2.URLError(e)
+			break
+
+		def on_drained():
+			if response.will_close:
+				connection.close()
+			else:
+				self._pool.release(scheme, host, connection)
+
+		pooled = _PooledResponse(response, on_drained, connection.close)
+		fp = socket._fileobject(pooled, close=True)
+
+		resp = urllib.addinfourl(fp, response.msg, req.get_full_url())
+		resp.code = response.status
+		resp.msg = response.reason
+		return resp
+
+
+class KeepAliveHTTPHandler(_KeepAliveMixin, urllib2.HTTPHandler):
+
+	def __init__(self, pool, debuglevel = 0):
+		urllib2.HTTPHandler.__init__(self, debuglevel)
+		self._pool = pool
+
+	def http_open(self, req):
+		return self._open_pooled("http", httplib.HTTPConnection, req)
+
+
+class KeepAliveHTTPSHandler(_KeepAliveMixin, urllib2.HTTPSHandler):
+
+	def __init__(self, pool, debuglevel = 0):
+		urllib2.HTTPSHandler.__init__(self, debuglevel)
+		self._pool = pool
+
+	def https_open(self, req):
+		return self._open_pooled("https", httplib.HTTPSConnection, req)
+
 
 class HTTPNoRedirector(urllib2.HTTPRedirectHandler):
 	"""This is a custom http redirect handler that FORBIDS redirection."""
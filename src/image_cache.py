@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+
+"""
+Size bounded disk cache of downloaded images, one file per key
+"""
+
+from __future__ import with_statement
+
+import os
+import time
+import tempfile
+import threading
+import cPickle
+import logging
+
+import util.io as io_utils
+
+
+_moduleLogger = logging.getLogger(__name__)
+
+
+class ImageCache(object):
+
+	INDEX_NAME = "index"
+
+	def __init__(self, cachePath, maxBytes = 16 * 1024 * 1024):
+		"""
+		@param maxBytes: Once the cached files add up to more than this the
+			least recently used are removed
+		"""
+		self._cachePath = cachePath
+		self._maxBytes = maxBytes
+		self._lock = threading.Lock()
+		# filename -> [size, last access]
+		self._entries = {}
+		self._size = 0
+		self._isDirty = False
+
+		io_utils.makedirs(self._cachePath)
+		self._load_index()
+
+	def get_path(self, key):
+		"""
+		@returns Path to the cached file for key or None
+		"""
+		filename = self._key_to_filename(key)
+		with self._lock:
+			entry = self._entries.get(filename, None)
+			if entry is None:
+				return None
+			path = os.path.join(self._cachePath, filename)
+			if not os.path.exists(path):
+				self._remove(filename)
+				return None
+			entry[1] = time.time()
+			self._isDirty = True
+		return path
+
+	def create_temp(self):
+		"""
+		@returns (file descriptor, path) of a temporary file to be handed to add
+		"""
+		return tempfile.mkstemp(dir=self._cachePath, prefix=".")
+
+	def add(self, key, tempPath):
+		"""
+		Move a completely written temporary file into place as the entry for key
+
+		@returns Path to the cached file
+		"""
+		filename = self._key_to_filename(key)
+		path = os.path.join(self._cachePath, filename)
+		size = os.path.getsize(tempPath)
+		os.rename(tempPath, path)
+		with self._lock:
+			self._remove(filename)
+			self._entries[filename] = [size, time.time()]
+			self._size += size
+			self._isDirty = True
+			if self._maxBytes < self._size:
+				self._evict(filename)
+		return path
+
+	def save(self):
+		"""
+		Write out the index so the next start doesn't need to stat every file
+		"""
+		with self._lock:
+			if not self._isDirty:
+				return
+			index = cPickle.dumps(self._entries, cPickle.HIGHEST_PROTOCOL)
+			self._isDirty = False
+
+		indexPath = os.path.join(self._cachePath, self.INDEX_NAME)
+		try:
+			# Dot prefixed like create_temp, so a leftover is cleaned up
+			io_utils.write_atomically(indexPath, index, prefix=".")
+		except (OSError, IOError):
+			_moduleLogger.exception("Could not save image cache index")
+
+	def get_stats(self):
+		with self._lock:
+			return {
+				"entries": len(self._entries),
+				"bytes": self._size,
+			}
+
+	def _load_index(self):
+		indexPath = os.path.join(self._cachePath, self.INDEX_NAME)
+		try:
+			with open(indexPath, "rb") as f:
+				self._entries = cPickle.load(f)
+		except IOError:
+			self._entries = {}
+		except Exception:
+			_moduleLogger.exception("Rebuilding unreadable image cache index")
+			self._entries = {}
+
+		# Reconcile with what is actually there, only files the index doesn't
+		# know about (say from a crash before it was saved) need a stat
+		now = time.time()
+		present = set()
+		for filename in os.listdir(self._cachePath):
+			if filename == self.INDEX_NAME:
+				continue
+			path = os.path.join(self._cachePath, filename)
+			if filename.startswith("."):
+				# Left over from an interrupted write
+				try:
+					os.remove(path)
+				except OSError:
+					pass
+				continue
+			present.add(filename)
+			if filename not in self._entries:
+				try:
+					self._entries[filename] = [os.path.getsize(path), now]
+				except OSError:
+					continue
+				self._isDirty = True
+		for filename in self._entries.keys():
+			if filename not in present:
+				del self._entries[filename]
+				self._isDirty = True
+
+		self._size = sum(size for size, lastAccess in self._entries.itervalues())
+		if self._maxBytes < self._size:
+			self._evict(None)
+
+	def _remove(self, filename):
+		entry = self._entries.pop(filename, None)
+		if entry is not None:
+			self._size -= entry[0]
+
+	def _evict(self, keepFilename):
+		byAge = sorted(self._entries.iteritems(), key = lambda item: item[1][1])
+		for filename, (size, lastAccess) in byAge:
+			if self._size <= self._maxBytes:
+				break
+			if filename == keepFilename:
+				continue
+			try:
+				os.remove(os.path.join(self._cachePath, filename))
+			except OSError:
+				_moduleLogger.exception("Could not evict %s" % filename)
+				continue
+			self._remove(filename)
+		self._isDirty = True
+
+	def _key_to_filename(self, key):
+		if isinstance(key, unicode):
+			key = key.encode("utf-8")
+		return io_utils.md5(key).hexdigest()
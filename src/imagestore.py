@@ -7,6 +7,7 @@ import cairo
 import gtk
 
 import browser_emu
+import image_cache
 from util import go_utils
 import util.misc as misc_utils
 
@@ -14,6 +15,77 @@ import util.misc as misc_utils
 _moduleLogger = logging.getLogger(__name__)
 
 
+class DecodedCache(object):
+	"""
+	Least recently used decoded images, bounded by their size in memory
+	"""
+
+	def __init__(self, maxBytes = 8 * 1024 * 1024):
+		self._maxBytes = maxBytes
+		self._entries = {}
+		self._size = 0
+		self._clock = 0
+		self._hits = 0
+		self._misses = 0
+
+	def get(self, key):
+		"""
+		@param key: (kind, name, size)
+		@returns The cached image or None
+		"""
+		entry = self._entries.get(key, None)
+		if entry is None:
+			self._misses += 1
+			return None
+		self._hits += 1
+		self._clock += 1
+		entry[2] = self._clock
+		return entry[0]
+
+	def set(self, key, image, byteCount):
+		self._remove(key)
+		if self._maxBytes < byteCount:
+			return
+		self._clock += 1
+		self._entries[key] = [image, byteCount, self._clock]
+		self._size += byteCount
+		if self._maxBytes < self._size:
+			self._evict()
+
+	def clear(self):
+		self._entries.clear()
+		self._size = 0
+
+	def get_stats(self):
+		return {
+			"hits": self._hits,
+			"misses": self._misses,
+			"entries": len(self._entries),
+			"bytes": self._size,
+		}
+
+	def _remove(self, key):
+		entry = self._entries.pop(key, None)
+		if entry is not None:
+			self._size -= entry[1]
+
+	def _evict(self):
+		byAge = sorted(self._entries.iteritems(), key = lambda item: item[1][2])
+		for key, entry in byAge:
+			if self._size <= self._maxBytes:
+				break
+			self._remove(key)
+
+
+def _pixbuf_bytes(pix):
+	return pix.get_rowstride() * pix.get_height()
+
+
+def _surface_bytes(surface):
+	# Store images are all ARGB32, and get_stride needs a newer pycairo
+	return 4 * surface.get_width() * surface.get_height()
+
+
 class ImageStore(object):
 
 	STORE_LOOKUP = {
@@ -54,84 +126,254 @@ class ImageStore(object):
 		"nomagazineimage": "nomagazineimage.png",
 	}
 
+	# Built by support/build_atlas.py, images not in it are loaded on their own
+	ATLAS_NAME = "atlas.png"
+	ATLAS_MAP_NAME = "atlas.map"
+
+	# Left in cachePath once the images downloaded before they were kept in
+	# an ImageCache, named after the end of their URL, are cleaned out
+	LEGACY_REMOVED_NAME = ".legacy-images-removed"
+
 	def __init__(self, storePath, cachePath):
 		self._storePath = storePath
 		self._cachePath = cachePath
+		self._atlasMap = self._load_atlas_map()
+		self._atlasPixbuf = None
+		self._atlasSurface = None
 
 		self._browser = browser_emu.MozillaEmulator()
-		self._downloader = go_utils.AsyncPool()
+		self._downloader = go_utils.AsyncPool(workers = 2)
+		self._decoded = DecodedCache()
+		self._downloaded = image_cache.ImageCache(os.path.join(self._cachePath, "images"))
 
 	def start(self):
 		self._downloader.start()
+		if not os.path.exists(os.path.join(self._cachePath, self.LEGACY_REMOVED_NAME)):
+			self._downloader.add_task(
+				self._remove_legacy_images,
+				(),
+				{},
+				self._on_legacy_images_removed,
+				lambda e: _moduleLogger.info("Could not remove old images: %s" % e),
+				go_utils.PRIORITY_PREFETCH,
+			)
 
 	def stop(self):
 		self._downloader.stop()
+		self._browser.close()
+		self._downloaded.save()
+		_moduleLogger.info("Decoded image cache stats: %r" % (self._decoded.get_stats(), ))
+		_moduleLogger.info("Downloaded image cache stats: %r" % (self._downloaded.get_stats(), ))
+
+	def get_cache_stats(self):
+		return self._decoded.get_stats()
 
 	def get_surface_from_store(self, imageName):
-		path = os.path.join(self._storePath, imageName)
-		image = cairo.ImageSurface.create_from_png(path)
+		key = "surface", imageName, None
+		image = self._decoded.get(key)
+		if image is None:
+			image = self._get_surface_from_atlas(imageName)
+			if image is None:
+				path = os.path.join(self._storePath, imageName)
+				image = cairo.ImageSurface.create_from_png(path)
+			self._decoded.set(key, image, _surface_bytes(image))
 		return image
 
 	def get_image_from_store(self, imageName):
-		path = os.path.join(self._storePath, imageName)
 		image = gtk.Image()
-		image.set_from_file(path)
+		image.set_from_pixbuf(self.get_pixbuf_from_store(imageName))
 		return image
 
 	def set_image_from_store(self, image, imageName):
-		path = os.path.join(self._storePath, imageName)
-		image.set_from_file(path)
+		image.set_from_pixbuf(self.get_pixbuf_from_store(imageName))
 		return image
 
 	def get_pixbuf_from_store(self, imageName):
-		path = os.path.join(self._storePath, imageName)
-		return gtk.gdk.pixbuf_new_from_file(path)
+		key = "pixbuf", imageName, None
+		pix = self._decoded.get(key)
+		if pix is None:
+			pix = self._get_pixbuf_from_atlas(imageName)
+			if pix is None:
+				path = os.path.join(self._storePath, imageName)
+				pix = gtk.gdk.pixbuf_new_from_file(path)
+			self._decoded.set(key, pix, _pixbuf_bytes(pix))
+		return pix
+
+	def get_pixbuf_from_url(self, url, on_success, on_error, size = None):
+		"""
+		Download (if needed), decode and scale happen off the main thread
 
-	def get_pixbuf_from_url(self, url, on_success, on_error):
+		@param size: Scale the image to fit a size by size box, None to keep
+			it as is
+		@returns go_utils.TaskHandle for the load or None when the image
+			was already decoded
+		"""
 		# @ todo Test bad image for both paths
-		filepath = self._url_to_cache(url)
-		if os.path.exists(filepath):
-			pix = gtk.gdk.pixbuf_new_from_file(filepath)
+		key = "url", url, size
+		pix = self._decoded.get(key)
+		if pix is not None:
 			try:
 				on_success(pix)
 			except Exception:
 				pass
-			doDownload = False
-		else:
-			doDownload = True
-
-		if doDownload:
-			self._get_image(
-				url,
-				lambda filepath: on_success(gtk.gdk.pixbuf_new_from_file(filepath)),
-				on_error,
-			)
+			return None
+
+		return self._get_image(url, size, on_success, on_error)
 
 	def get_pixbuf_animation_from_store(self, imageName):
 		path = os.path.join(self._storePath, imageName)
 		return gtk.gdk.PixbufAnimation(path)
 
-	def _get_image(self, url, on_success, on_error):
-		self._downloader.add_task(
-			self._browser.download,
-			(url, ),
+	def _load_atlas_map(self):
+		"""
+		@returns {imageName: (x, y, width, height)}, empty without an atlas
+		"""
+		atlasMap = {}
+		try:
+			mapFile = open(os.path.join(self._storePath, self.ATLAS_MAP_NAME), "r")
+		except IOError:
+			_moduleLogger.info("No image atlas, loading images individually")
+			return atlasMap
+		try:
+			for line in mapFile:
+				line = line.strip()
+				if not line or line.startswith("#"):
+					continue
+				name, x, y, width, height = line.split()
+				atlasMap[name] = int(x), int(y), int(width), int(height)
+		finally:
+			mapFile.close()
+		return atlasMap
+
+	def _get_pixbuf_from_atlas(self, imageName):
+		rect = self._atlasMap.get(imageName, None)
+		if rect is None:
+			return None
+		if self._atlasPixbuf is None:
+			try:
+				self._atlasPixbuf = gtk.gdk.pixbuf_new_from_file(
+					os.path.join(self._storePath, self.ATLAS_NAME)
+				)
+			except Exception:
+				_moduleLogger.exception("Could not load the image atlas")
+				self._atlasMap = {}
+				return None
+		x, y, width, height = rect
+		# Shares the atlas' pixels rather than copying them
+		return self._atlasPixbuf.subpixbuf(x, y, width, height)
+
+	def _get_surface_from_atlas(self, imageName):
+		rect = self._atlasMap.get(imageName, None)
+		if rect is None:
+			return None
+		if self._atlasSurface is None:
+			try:
+				self._atlasSurface = cairo.ImageSurface.create_from_png(
+					os.path.join(self._storePath, self.ATLAS_NAME)
+				)
+			except Exception:
+				_moduleLogger.exception("Could not load the image atlas")
+				self._atlasMap = {}
+				return None
+		x, y, width, height = rect
+		surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+		context = cairo.Context(surface)
+		context.set_source_surface(self._atlasSurface, -x, -y)
+		context.paint()
+		return surface
+
+	def _get_image(self, url, size, on_success, on_error):
+		return self._downloader.add_task(
+			self._load_image,
+			(url, size),
 			{},
-			lambda image: self._on_get_image(url, image, on_success, on_error),
+			lambda pix: self._on_get_image(("url", url, size), pix, on_success, on_error),
 			on_error,
+			go_utils.PRIORITY_THUMBNAIL,
 		)
 
+	def _load_image(self, url, size):
+		if size is not None:
+			thumbnailPath = self._downloaded.get_path(self._thumbnail_key(url, size))
+			if thumbnailPath is not None:
+				try:
+					return gtk.gdk.pixbuf_new_from_file(thumbnailPath)
+				except Exception:
+					_moduleLogger.exception("Ignoring bad thumbnail of %s" % url)
+
+		filepath = self._downloaded.get_path(url)
+		if filepath is None:
+			filepath = self._download_image(url)
+		if size is None:
+			return gtk.gdk.pixbuf_new_from_file(filepath)
+
+		pix = gtk.gdk.pixbuf_new_from_file_at_size(filepath, size, size)
+		self._save_thumbnail(url, size, pix)
+		return pix
+
+	def _save_thumbnail(self, url, size, pix):
+		"""
+		Keep the scaled image next to the original so the next time only the
+		small one needs decoding
+		"""
+		fd, tempPath = self._downloaded.create_temp()
+		os.close(fd)
+		try:
+			pix.save(tempPath, "png")
+			self._downloaded.add(self._thumbnail_key(url, size), tempPath)
+		except Exception:
+			_moduleLogger.exception("Could not save thumbnail of %s" % url)
+			try:
+				os.remove(tempPath)
+			except OSError:
+				pass
+
+	def _thumbnail_key(self, url, size):
+		return "%s#thumbnail-%d" % (url, size)
+
+	def _download_image(self, url):
+		"""
+		Stream the image to disk, only moving it into place once complete
+		"""
+		fd, tempPath = self._downloaded.create_temp()
+		try:
+			with os.fdopen(fd, "wb") as f:
+				size = self._browser.download_to(url, f)
+			filepath = self._downloaded.add(url, tempPath)
+		except:
+			try:
+				os.remove(tempPath)
+			except OSError:
+				pass
+			raise
+		_moduleLogger.info("Saved %s (%d bytes)" % (filepath, size))
+		return filepath
+
 	@misc_utils.log_exception(_moduleLogger)
-	def _on_get_image(self, url, image, on_success, on_error):
+	def _on_get_image(self, key, pix, on_success, on_error):
+		self._decoded.set(key, pix, _pixbuf_bytes(pix))
 		try:
-			filepath = self._url_to_cache(url)
-			_moduleLogger.info("Saved %s" % filepath)
-			with open(filepath, "wb") as f:
-				f.write(image)
-			on_success(filepath)
+			on_success(pix)
 		except Exception, e:
 			on_error(e)
 
-	def _url_to_cache(self, url):
-		filename = url.rsplit("/", 1)[-1]
-		filepath = os.path.join(self._cachePath, filename)
-		return filepath
+	def _remove_legacy_images(self):
+		"""
+		@returns Number of files removed
+		"""
+		removed = 0
+		for filename in os.listdir(self._cachePath):
+			path = os.path.join(self._cachePath, filename)
+			if filename.startswith(".") or not os.path.isfile(path):
+				continue
+			try:
+				os.remove(path)
+				removed += 1
+			except OSError:
+				_moduleLogger.exception("Could not remove %s" % filename)
+		open(os.path.join(self._cachePath, self.LEGACY_REMOVED_NAME), "w").close()
+		return removed
+
+	@misc_utils.log_exception(_moduleLogger)
+	def _on_legacy_images_removed(self, removed):
+		_moduleLogger.info("Removed %d images cached the old way" % removed)
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+"""
+Results of index queries kept across sessions so the catalog can be browsed
+instantly, even without a network connection
+"""
+
+from __future__ import with_statement
+
+import os
+import time
+import zlib
+import threading
+import anydbm
+import cPickle
+import logging
+
+
+_moduleLogger = logging.getLogger(__name__)
+
+
+class IndexSnapshot(object):
+	"""
+	One record on disk per query, read when the query is asked for, so only
+	what the tree currently holds is in memory.  Every call goes to disk,
+	keep them off the main thread
+	"""
+
+	# Bump when the layout of the stored entries changes
+	VERSION = 2
+
+	_VERSION_KEY = "version"
+	_QUERY_PREFIX = "query:"
+	_CRAWLED_PREFIX = "crawled:"
+
+	def __init__(self, path):
+		self._path = path
+		self._lock = threading.Lock()
+		self._db = None
+
+	def get(self, key):
+		"""
+		@returns (age in seconds, result) or None
+		"""
+		dbKey = self._QUERY_PREFIX + repr(key)
+		with self._lock:
+			try:
+				record = self._open()[dbKey]
+			except KeyError:
+				return None
+		try:
+			timestamp, result = cPickle.loads(zlib.decompress(record))
+		except Exception:
+			_moduleLogger.exception("Ignoring unreadable snapshot entry for %r" % (key, ))
+			return None
+		return time.time() - timestamp, result
+
+	def set(self, key, result):
+		dbKey = self._QUERY_PREFIX + repr(key)
+		record = zlib.compress(cPickle.dumps((time.time(), result), cPickle.HIGHEST_PROTOCOL))
+		with self._lock:
+			self._open()[dbKey] = record
+
+	def is_crawled(self, name):
+		with self._lock:
+			return self._open().has_key(self._CRAWLED_PREFIX + name)
+
+	def mark_crawled(self, name):
+		with self._lock:
+			self._open()[self._CRAWLED_PREFIX + name] = ""
+
+	def clear(self):
+		with self._lock:
+			self._close()
+			self._create()
+
+	def save(self):
+		"""
+		Flush what has been set out to disk
+		"""
+		with self._lock:
+			if self._db is not None and hasattr(self._db, "sync"):
+				self._db.sync()
+
+	def close(self):
+		with self._lock:
+			self._close()
+
+	def _open(self):
+		if self._db is not None:
+			return self._db
+		try:
+			self._db = anydbm.open(self._path, "c")
+			# Not every dbm module has get
+			if self._db.has_key(self._VERSION_KEY):
+				version = self._db[self._VERSION_KEY]
+			else:
+				version = None
+		except anydbm.error, e:
+			# Including a snapshot from before entries were stored separately
+			_moduleLogger.info("Discarding unreadable snapshot %s: %s" % (self._path, e))
+			self._close()
+			self._create()
+		except Exception:
+			_moduleLogger.exception("Discarding unreadable snapshot %s" % self._path)
+			self._close()
+			self._create()
+		else:
+			if version != str(self.VERSION):
+				_moduleLogger.info("Discarding snapshot of version %r" % (version, ))
+				self._close()
+				self._create()
+		return self._db
+
+	def _create(self):
+		try:
+			# Whatever is there may not even be a database
+			os.remove(self._path)
+		except OSError:
+			pass
+		self._db = anydbm.open(self._path, "n")
+		self._db[self._VERSION_KEY] = str(self.VERSION)
+
+	def _close(self):
+		if self._db is None:
+			return
+		db, self._db = self._db, None
+		try:
+			db.close()
+		except Exception:
+			_moduleLogger.exception("Error closing snapshot %s" % self._path)
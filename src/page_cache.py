@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+
+"""
+Persistent cache of raw API responses, one file per query
+"""
+
+from __future__ import with_statement
+
+import os
+import time
+import threading
+import logging
+
+import util.io as io_utils
+
+
+_moduleLogger = logging.getLogger(__name__)
+
+
+class PageCache(object):
+
+	def __init__(self, cachePath):
+		self._cachePath = cachePath
+		self._lock = threading.Lock()
+		self._hits = 0
+		self._misses = 0
+		self._stale = 0
+
+		io_utils.makedirs(self._cachePath)
+
+	def get(self, key, ttl):
+		"""
+		@returns The cached page if it is younger than ttl seconds, else None
+		"""
+		path = self._key_to_path(key)
+		try:
+			age = time.time() - os.path.getmtime(path)
+			if age < 0 or ttl <= age:
+				page = None
+			else:
+				page = self._read(path)
+		except (OSError, IOError):
+			page = None
+
+		with self._lock:
+			if page is None:
+				self._misses += 1
+			else:
+				self._hits += 1
+		return page
+
+	def get_stale(self, key):
+		"""
+		Fall back to an outdated page
+
+		@returns The cached page no matter its age, else None
+		"""
+		page = self.peek(key)
+		if page is None:
+			return None
+
+		with self._lock:
+			self._stale += 1
+		return page
+
+	def peek(self, key):
+		"""
+		Like get_stale but not counted in the stats, for revalidating the page
+
+		@returns The cached page no matter its age, else None
+		"""
+		path = self._key_to_path(key)
+		try:
+			return self._read(path)
+		except (OSError, IOError):
+			return None
+
+	def set(self, key, page):
+		try:
+			io_utils.write_atomically(self._key_to_path(key), page)
+		except (OSError, IOError):
+			_moduleLogger.exception("Could not cache %s" % key)
+
+	def create_writer(self, key):
+		"""
+		For storing a page a chunk at a time as it is downloaded
+
+		@returns PageWriter, the page replaces the entry for key once it is
+			committed
+		"""
+		return PageWriter(self._key_to_path(key), key)
+
+	def clear(self):
+		for filename in os.listdir(self._cachePath):
+			try:
+				os.remove(os.path.join(self._cachePath, filename))
+			except OSError:
+				_moduleLogger.exception("Could not remove %s" % filename)
+
+	def purge(self, maxAge):
+		"""
+		Remove pages that haven't been stored in maxAge seconds
+
+		@returns Number of pages removed
+		"""
+		return io_utils.purge_older_than(self._cachePath, maxAge)
+
+	def get_stats(self):
+		with self._lock:
+			return {
+				"hits": self._hits,
+				"misses": self._misses,
+				"stale": self._stale,
+			}
+
+	def _read(self, path):
+		with open(path, "rb") as f:
+			return f.read()
+
+	def _key_to_path(self, key):
+		filename = io_utils.md5(key).hexdigest()
+		return os.path.join(self._cachePath, filename)
+
+
+class PageWriter(object):
+
+	def __init__(self, path, key):
+		self._key = key
+		self._f = io_utils.AtomicFile(path)
+		self._isFailed = False
+
+	def write(self, data):
+		if self._isFailed:
+			return
+		try:
+			self._f.write(data)
+		except IOError:
+			# Not being able to cache the page shouldn't fail the download
+			_moduleLogger.exception("Could not cache %s" % self._key)
+			self._isFailed = True
+
+	def commit(self):
+		if self._isFailed:
+			self._f.abort()
+			return
+		try:
+			self._f.commit()
+		except (OSError, IOError):
+			_moduleLogger.exception("Could not cache %s" % self._key)
+
+	def abort(self):
+		self._f.abort()
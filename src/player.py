@@ -3,6 +3,7 @@ import logging
 import gobject
 
 import util.misc as misc_utils
+import util.go_utils as go_utils
 try:
 	import stream_gst
 	stream = stream_gst
@@ -49,6 +50,8 @@ class Player(gobject.GObject):
 		self._index = index
 		self._node = None
 		self._nextSearch = None
+		self._prefetchers = {}
+		self._prefetched = {}
 
 		self._calls = call_monitor.CallMonitor()
 		self._calls.connect("call_start", self._on_call_start)
@@ -107,6 +110,10 @@ class Player(gobject.GObject):
 	def back(self, forcePlay = False):
 		_moduleLogger.info("back")
 		assert self._nextSearch is None
+		previousNode = self._prefetched.get("previous", None)
+		if previousNode is not None:
+			self._on_next_node(previousNode, forcePlay)
+			return
 		self._nextSearch = stream_index.AsyncWalker(stream_index.get_previous)
 		self._nextSearch.start(
 			self.node,
@@ -117,6 +124,10 @@ class Player(gobject.GObject):
 	def next(self, forcePlay = False):
 		_moduleLogger.info("next")
 		assert self._nextSearch is None
+		nextNode = self._prefetched.get("next", None)
+		if nextNode is not None:
+			self._on_next_node(nextNode, forcePlay)
+			return
 		self._nextSearch = stream_index.AsyncWalker(stream_index.get_next)
 		self._nextSearch.start(
 			self.node,
@@ -138,11 +149,59 @@ class Player(gobject.GObject):
 		if self._node is node:
 			_moduleLogger.info("Already set to %r" % node)
 			return
+		if self._node is not None:
+			self._node.unpin()
 		self._node = node
 		if self._node is not None:
+			self._node.pin()
 			self._stream.set_file(self._node.uri)
 		_moduleLogger.info("New node %r" % self._node)
 		self.emit("title_change", self._node)
+		self._prefetch_neighbors()
+
+	def _prefetch_neighbors(self):
+		"""
+		Resolve the pieces on either side of the current one in the background
+		so next/back (and auto-advancing at EOF) don't wait on the network
+		"""
+		for walker in self._prefetchers.itervalues():
+			walker.cancel()
+		self._prefetchers.clear()
+		for neighbor in self._prefetched.itervalues():
+			neighbor.unpin()
+		self._prefetched.clear()
+
+		node = self._node
+		if node is None or not node.can_navigate:
+			return
+		for direction, func in (
+			("next", stream_index.get_next),
+			("previous", stream_index.get_previous),
+		):
+			walker = stream_index.AsyncWalker(func, go_utils.PRIORITY_PREFETCH)
+			self._prefetchers[direction] = walker
+			walker.start(
+				node,
+				lambda neighbor, direction = direction: self._on_prefetched(node, direction, neighbor),
+				lambda e, direction = direction: self._on_prefetch_error(node, direction, e),
+			)
+
+	@misc_utils.log_exception(_moduleLogger)
+	def _on_prefetched(self, node, direction, neighbor):
+		if self._node is not node:
+			return
+		_moduleLogger.debug("Prefetched %s of %r: %r" % (direction, node, neighbor))
+		self._prefetchers.pop(direction, None)
+		neighbor.pin()
+		self._prefetched[direction] = neighbor
+
+	@misc_utils.log_exception(_moduleLogger)
+	def _on_prefetch_error(self, node, direction, e):
+		if self._node is not node:
+			return
+		# Not fatal, next/back will search again when asked
+		_moduleLogger.info("Could not prefetch %s of %r: %s" % (direction, node, e))
+		self._prefetchers.pop(direction, None)
 
 	@misc_utils.log_exception(_moduleLogger)
 	def _on_next_node(self, node, forcePlay):
@@ -1,9 +1,11 @@
 import weakref
+import datetime
 import logging
 
 import util.misc as misc_utils
 from util import go_utils
 import backend
+import index_snapshot
 
 
 _moduleLogger = logging.getLogger(__name__)
@@ -17,35 +19,317 @@ SOURCE_SCRIPTURES = "scriptures"
 
 class Connection(object):
 
-	def __init__(self):
-		self._backend = backend.Backend()
-		self._indexing = go_utils.AsyncPool()
+	# Queries worth keeping in the snapshot, radio programming is only good
+	# for the day it is for
+	SNAPSHOT_FUNCS = frozenset((
+		"get_languages",
+		"get_radio_channels",
+		"get_conferences",
+		"get_conference_sessions",
+		"get_conference_talks",
+		"get_magazines",
+		"get_magazine_issues",
+		"get_magazine_articles",
+		"get_scriptures",
+		"get_scripture_books",
+		"get_scripture_chapters",
+	))
+
+	# Seconds before a snapshot entry gets refreshed in the background
+	SNAPSHOT_REFRESH = 24 * 60 * 60
+
+	def __init__(self, cachePath = None, retryPolicy = None, snapshot = None):
+		"""
+		@param snapshot: IndexSnapshot queries are answered from before going
+			to the network
+		"""
+		self._backend = backend.Backend(cachePath, retryPolicy)
+		self._indexing = go_utils.AsyncPool(workers = 3)
+		self._inFlight = {}
+		self._snapshot = snapshot
+		self.nodeCache = NodeCache()
 
 	def start(self):
 		self._indexing.start()
+		self._indexing.add_task(
+			self._backend.purge_cache,
+			(),
+			{},
+			self._on_purged,
+			lambda e: _moduleLogger.info("Could not purge cache: %s" % e),
+			go_utils.PRIORITY_PREFETCH,
+		)
 
 	def stop(self):
 		self._indexing.stop()
+		self._backend.close()
+		if self._snapshot is not None:
+			self._snapshot.close()
+		_moduleLogger.info("API cache stats: %r" % (self._backend.get_cache_stats(), ))
+
+	def is_crawled(self, name, on_success, on_error):
+		"""
+		Check the snapshot for name having been marked crawled
+		"""
+		return self._indexing.add_task(
+			self._snapshot.is_crawled,
+			(name, ),
+			{},
+			on_success,
+			on_error,
+			go_utils.PRIORITY_PREFETCH,
+		)
 
-	def download(self, func, on_success, on_error, args = None, kwds = None):
+	def mark_crawled(self, name):
+		self._indexing.add_task(
+			self._mark_crawled,
+			(name, ),
+			{},
+			lambda result: None,
+			lambda e: _moduleLogger.info("Could not mark %s crawled: %s" % (name, e)),
+			go_utils.PRIORITY_PREFETCH,
+		)
+
+	def save_snapshot(self):
+		if self._snapshot is None:
+			return
+		self._indexing.add_task(
+			self._snapshot.save,
+			(),
+			{},
+			lambda result: None,
+			lambda e: _moduleLogger.info("Could not save snapshot: %s" % e),
+			go_utils.PRIORITY_PREFETCH,
+		)
+
+	def download(self, func, on_success, on_error, args = None, kwds = None, priority = go_utils.PRIORITY_INTERACTIVE):
+		"""
+		Identical requests made while one is already queued or running share
+		its result rather than fetching again
+
+		@returns go_utils.TaskHandle, the shared fetch is only cancelled once
+			every request sharing it is
+		"""
 		if args is None:
 			args = ()
 		if kwds is None:
 			kwds = {}
 
-		self._indexing.add_task(
-			getattr(self._backend, func),
-			args,
-			kwds,
-			on_success,
-			on_error,
+		key = func, args, tuple(sorted(kwds.iteritems()))
+		try:
+			flight = self._inFlight.get(key, None)
+		except TypeError:
+			# Unhashable arguments, don't bother coalescing
+			return self._indexing.add_task(
+				getattr(self._backend, func),
+				args,
+				kwds,
+				on_success,
+				on_error,
+				priority,
+			)
+
+		if flight is None:
+			flight = self._queue_flight(key, func, args, kwds, priority, False)
+		elif priority < flight["priority"] and flight["task"].withdraw():
+			# Someone is waiting on what was only a background fetch, requeue
+			# it so it doesn't sit behind the rest of the background work.
+			# Once a worker has it there is nothing to gain
+			self._queue_flight(key, func, args, kwds, priority, flight["isRefresh"])
+
+		waiter = [on_success, on_error, None]
+		waiter[2] = go_utils.TaskHandle(lambda: self._on_waiter_cancelled(key, flight, waiter))
+		flight["waiters"].append(waiter)
+		return waiter[2]
+
+	def _is_snapshotted(self, func):
+		return self._snapshot is not None and func in self.SNAPSHOT_FUNCS
+
+	def _fetch(self, func, args, kwds, isRefresh):
+		"""
+		Runs on the indexing pool, so the snapshot is never touched from the
+		main loop
+
+		@returns (isStale, result), a stale result is from the snapshot and
+			due for a refresh
+		"""
+		if self._is_snapshotted(func):
+			key = func, args, tuple(sorted(kwds.iteritems()))
+			if not isRefresh:
+				snapshotted = self._snapshot.get(key)
+				if snapshotted is not None:
+					age, result = snapshotted
+					return self.SNAPSHOT_REFRESH <= age, result
+			result = getattr(self._backend, func)(*args, **kwds)
+			self._snapshot.set(key, result)
+		else:
+			result = getattr(self._backend, func)(*args, **kwds)
+		return False, result
+
+	def _mark_crawled(self, name):
+		self._snapshot.mark_crawled(name)
+		self._snapshot.save()
+
+	def _queue_flight(self, key, func, args, kwds, priority, isRefresh):
+		flight = self._inFlight.get(key, None)
+		if flight is None:
+			flight = self._inFlight[key] = {"waiters": [], "task": None, "priority": None}
+		flight["priority"] = priority
+		flight["isRefresh"] = isRefresh
+		flight["task"] = self._indexing.add_task(
+			self._fetch,
+			(func, args, kwds, isRefresh),
+			{},
+			lambda result: self._on_download(key, False, result),
+			lambda error: self._on_download(key, True, error),
+			priority,
 		)
+		return flight
+
+	@misc_utils.log_exception(_moduleLogger)
+	def _on_purged(self, removed):
+		_moduleLogger.info("Purged %d old pages from the cache" % removed)
+
+	def _on_waiter_cancelled(self, key, flight, waiter):
+		flight["waiters"].remove(waiter)
+		if not flight["waiters"] and self._inFlight.get(key, None) is flight:
+			del self._inFlight[key]
+			flight["task"].cancel()
+
+	@misc_utils.log_exception(_moduleLogger)
+	def _on_download(self, key, isError, result):
+		flight = self._inFlight.pop(key)
+		if not isError:
+			isStale, result = result
+			if isStale:
+				# Quietly re-download, the fresh result is used from the next
+				# time it is asked for
+				func, args, kwds = key
+				self._queue_flight(key, func, args, dict(kwds), go_utils.PRIORITY_PREFETCH, True)
+		for on_success, on_error, handle in flight["waiters"]:
+			handle.finish()
+			callback = on_error if isError else on_success
+			try:
+				callback(result)
+			except Exception:
+				_moduleLogger.exception("Callback errored")
+
+
+class NodeCache(object):
+	"""
+	Bounds the number of child nodes kept loaded across a whole tree.  Once
+	over budget the least recently used child lists are dropped, except for
+	those leading to a pinned node (what's playing, what a window shows) or
+	to the list just loaded, and are fetched again the next time they are
+	asked for
+
+	>>> cache = NodeCache(maxChildren = 12)
+	>>> root = Node(None, None, {}, 0)
+	>>> root._children = [Node(None, root, {}, i) for i in xrange(5)]
+	>>> cache.add(root, 5)
+	>>> cache.pin(root)
+	>>> old, new = root._children[0], root._children[1]
+	>>> old._children = [Node(None, old, {}, i) for i in xrange(5)]
+	>>> cache.add(old, 5)
+	>>> new._children = [Node(None, new, {}, i) for i in xrange(5)]
+	>>> cache.add(new, 5)
+	>>> old._children, len(new._children), len(root._children)
+	(None, 5, 5)
+	>>> sorted(cache.get_stats().items())
+	[('children', 10), ('parents', 2), ('pinned', 1)]
+	"""
+
+	def __init__(self, maxChildren = 5000):
+		"""
+		@param maxChildren: Budget of loaded child nodes across all parents
+		"""
+		self._maxChildren = maxChildren
+		self._entries = {}
+		self._pinned = {}
+		self._size = 0
+		self._clock = 0
+
+	def add(self, node, count):
+		"""
+		Record that node just loaded count children
+		"""
+		key = id(node)
+		self._remove(key)
+		self._clock += 1
+		ref = weakref.ref(node, lambda ref: self._remove(key))
+		self._entries[key] = [ref, count, self._clock]
+		self._size += count
+		if self._maxChildren < self._size:
+			self._evict(node)
+
+	def touch(self, node):
+		entry = self._entries.get(id(node), None)
+		if entry is not None:
+			self._clock += 1
+			entry[2] = self._clock
+
+	def pin(self, node):
+		key = id(node)
+		pinned = self._pinned.get(key, None)
+		if pinned is None:
+			self._pinned[key] = [node, 1]
+		else:
+			pinned[1] += 1
+
+	def unpin(self, node):
+		key = id(node)
+		pinned = self._pinned[key]
+		pinned[1] -= 1
+		if pinned[1] == 0:
+			del self._pinned[key]
+
+	def get_stats(self):
+		return {
+			"parents": len(self._entries),
+			"children": self._size,
+			"pinned": len(self._pinned),
+		}
+
+	def _remove(self, key):
+		entry = self._entries.pop(key, None)
+		if entry is not None:
+			self._size -= entry[1]
+
+	def _evict(self, keepNode):
+		protected = set(id(ancestor) for ancestor in walk_ancestors(keepNode))
+		for node, count in self._pinned.itervalues():
+			protected.update(id(ancestor) for ancestor in walk_ancestors(node))
+
+		# Drop down to a low water mark so we aren't evicting on every load
+		target = self._maxChildren * 3 // 4
+		byAge = sorted(self._entries.iteritems(), key = lambda item: item[1][2])
+		for key, (ref, count, lastUsed) in byAge:
+			if self._size <= target:
+				break
+			if key in protected or key not in self._entries:
+				continue
+			node = ref()
+			self._remove(key)
+			if node is not None:
+				# Descendants are released with the list, their weakrefs
+				# clean up their own entries
+				node._children = None
+		_moduleLogger.debug("Evicted child lists: %r" % (self.get_stats(), ))
 
 
 class AudioIndex(object):
 
-	def __init__(self):
-		self._connection = Connection()
+	def __init__(self, cachePath = None, snapshotPath = None):
+		"""
+		@param snapshotPath: File to keep the catalog in between sessions, None
+			to always go to the network
+		"""
+		if snapshotPath is not None:
+			self._snapshot = index_snapshot.IndexSnapshot(snapshotPath)
+		else:
+			self._snapshot = None
+		self._connection = Connection(cachePath, snapshot = self._snapshot)
+		self._crawlers = {}
 		self._languages = None
 		self._languagesRequest = None
 		self._sources = {}
@@ -54,8 +338,32 @@ class AudioIndex(object):
 		self._connection.start()
 
 	def stop(self):
+		for crawler in self._crawlers.itervalues():
+			if crawler is not None:
+				crawler.cancel()
+		self._crawlers.clear()
 		self._connection.stop()
 
+	def crawl_source(self, source, langId = None):
+		"""
+		Walk the whole tree of a source in the background, filling the
+		snapshot.  Only done once, after that entries are refreshed as they
+		get browsed
+		"""
+		if self._snapshot is None:
+			return
+		key = (source, langId)
+		if key in self._crawlers:
+			return
+		name = "%s-%s" % key
+		# Checking the snapshot goes to disk, the crawler is filled in after
+		self._crawlers[key] = None
+		self._connection.is_crawled(
+			name,
+			lambda isCrawled: self._on_checked_crawled(key, name, isCrawled),
+			lambda e: self._on_checked_crawled(key, name, False),
+		)
+
 	def get_languages(self, on_success, on_error):
 		if self._languages is None:
 			assert self._languagesRequest is None
@@ -90,6 +398,31 @@ class AudioIndex(object):
 
 		return node
 
+	@misc_utils.log_exception(_moduleLogger)
+	def _on_checked_crawled(self, key, name, isCrawled):
+		if key not in self._crawlers:
+			# Stopped in the mean time
+			return
+		if isCrawled:
+			del self._crawlers[key]
+			return
+		source, langId = key
+		crawler = _Crawler(self.get_source(source, langId))
+		self._crawlers[key] = crawler
+		crawler.start(
+			lambda count, errors: self._on_crawled(key, name, count, errors),
+		)
+
+	@misc_utils.log_exception(_moduleLogger)
+	def _on_crawled(self, key, name, count, errors):
+		del self._crawlers[key]
+		_moduleLogger.info("Crawled %d nodes of %s (%d failed)" % (count, name, errors))
+		if not errors:
+			# Otherwise try again next time, what did load is served from the snapshot
+			self._connection.mark_crawled(name)
+		else:
+			self._connection.save_snapshot()
+
 	@misc_utils.log_exception(_moduleLogger)
 	def _on_get_languages(self, languages):
 		assert self._languages is None
@@ -117,11 +450,17 @@ class Node(object):
 		self._children = None
 		self._id = id
 
-	def get_children(self, on_success, on_error):
+	def get_children(self, on_success, on_error, priority = go_utils.PRIORITY_INTERACTIVE):
+		"""
+		@returns go_utils.TaskHandle for the fetch or None when the children
+			were already available
+		"""
 		if self._children is None:
-			self._get_children(on_success, on_error)
+			return self._get_children(on_success, on_error, priority)
 		else:
+			self._connection.nodeCache.touch(self)
 			on_success(self._children)
+			return None
 
 	def get_parent(self):
 		if self._parent is None:
@@ -129,6 +468,28 @@ class Node(object):
 		parent = self._parent()
 		return parent
 
+	def pin(self):
+		"""
+		Keep the path down to this node loaded until unpinned
+		"""
+		self._connection.nodeCache.pin(self)
+
+	def unpin(self):
+		self._connection.nodeCache.unpin(self)
+
+	def get_sibling(self, offset):
+		"""
+		@returns The node offset places away under the same parent, None when
+			that runs past either end or the parent's children aren't loaded
+		"""
+		parent = self.get_parent()
+		if parent is None or parent._children is None:
+			return None
+		i = find_child_index(parent._children, self) + offset
+		if 0 <= i < len(parent._children):
+			return parent._children[i]
+		return None
+
 	def get_properties(self):
 		return self._data
 
@@ -143,7 +504,7 @@ class Node(object):
 	def is_leaf(self):
 		raise NotImplementedError("")
 
-	def _get_children(self, on_success, on_error):
+	def _get_children(self, on_success, on_error, priority):
 		raise NotImplementedError("")
 
 
@@ -155,17 +516,35 @@ class ParentNode(Node):
 	def is_leaf(self):
 		return False
 
-	def _get_children(self, on_success, on_error):
+	@staticmethod
+	def get_children_of(nodes, on_node_success, on_node_error, on_done = None, priority = go_utils.PRIORITY_INTERACTIVE):
+		"""
+		Fetch the children of several nodes at once rather than one after
+		another
+
+		@param on_node_success: Called with (node, children) as each node loads
+		@param on_node_error: Called with (node, error) as each node fails
+		@param on_done: Called with no arguments once every node has loaded
+			or failed
+		@returns go_utils.TaskHandle cancelling whatever is still outstanding
+		"""
+		fanOut = _FanOut(nodes, on_node_success, on_node_error, on_done)
+		handle = go_utils.TaskHandle(fanOut.cancel)
+		fanOut.start(handle, priority)
+		return handle
+
+	def _get_children(self, on_success, on_error, priority):
 		assert self._children is None
 
 		func, args, kwds = self._get_func()
 
-		self._connection.download(
+		return self._connection.download(
 			func,
 			lambda data: self._on_success(data, on_success, on_error),
 			on_error,
 			args,
 			kwds,
+			priority,
 		)
 
 	def _get_func(self):
@@ -176,17 +555,22 @@ class ParentNode(Node):
 
 	@misc_utils.log_exception(_moduleLogger)
 	def _on_success(self, data, on_success, on_error):
+		if self._children is not None:
+			# A coalesced request for the same children already built them
+			on_success(self._children)
+			return
 		try:
-			self._children = [
+			children = [
 				self._create_child(child, i)
 				for i, child in enumerate(data)
 			]
 		except Exception, e:
 			_moduleLogger.exception("Translating error")
-			self._children = None
 			on_error(e)
 		else:
-			on_success(self._children)
+			self._children = children
+			self._connection.nodeCache.add(self, len(children))
+			on_success(children)
 
 
 class LeafNode(Node):
@@ -209,7 +593,7 @@ class LeafNode(Node):
 	def uri(self):
 		raise NotImplementedError("On %s" % type(self))
 
-	def _get_children(self, on_success, on_error):
+	def _get_children(self, on_success, on_error, priority):
 		raise RuntimeError("Not is a leaf")
 
 
@@ -231,10 +615,15 @@ class RadioNode(ParentNode):
 
 class RadioChannelNode(LeafNode):
 
+	# Days of programming kept in memory, those furthest from the day last
+	# asked for go first
+	MAX_CACHED_DAYS = 15
+
 	def __init__(self, connection, parent, data, id):
 		LeafNode.__init__(self, connection, parent, data, id)
 		self._extendedData = {}
-		self._request = None
+		self._prefetching = {}
+		self._lastDate = None
 
 	@property
 	def can_navigate(self):
@@ -253,49 +642,83 @@ class RadioChannelNode(LeafNode):
 		return self._data["url"]
 
 	def get_programming(self, date, on_success, on_error):
+		"""
+		Requests for different days may be outstanding at the same time
+
+		@returns go_utils.TaskHandle for the fetch or None when the
+			programming was already available
+		"""
+		self._lastDate = date
 		date = date.strftime("%Y-%m-%d")
 		try:
 			programming = self._extendedData[date]
 		except KeyError:
-			self._get_programming(date, on_success, on_error)
+			return self._get_programming(date, on_success, on_error, go_utils.PRIORITY_INTERACTIVE)
 		else:
 			on_success(programming)
+			return None
+
+	def prefetch_programming(self, date, days = 3):
+		"""
+		Load the programming for the days either side of date in the background
+		"""
+		for offset in xrange(-days, days + 1):
+			day = (date + datetime.timedelta(days = offset)).strftime("%Y-%m-%d")
+			if day in self._extendedData or day in self._prefetching:
+				continue
+			self._prefetching[day] = self._get_programming(
+				day,
+				lambda programming, day = day: self._prefetching.pop(day, None),
+				lambda error, day = day: self._on_prefetch_error(day, error),
+				go_utils.PRIORITY_PREFETCH,
+			)
 
-	def _get_programming(self, date, on_success, on_error):
-		assert self._request is None
-		assert date not in self._extendedData
-		self._request = on_success, on_error, date
-
-		self._connection.download(
+	def _get_programming(self, date, on_success, on_error, priority):
+		return self._connection.download(
 			"get_radio_channel_programming",
-			self._on_success,
-			self._on_error,
+			lambda data: self._on_success(date, data, on_success, on_error),
+			on_error,
 			(self._data["id"], date),
 			{},
+			priority,
 		)
 
+	def _evict_programming(self):
+		if len(self._extendedData) <= self.MAX_CACHED_DAYS or self._lastDate is None:
+			return
+		lastDate = self._lastDate.date()
+
+		def distance(day):
+			year, month, dayOfMonth = (int(part) for part in day.split("-"))
+			return abs((datetime.date(year, month, dayOfMonth) - lastDate).days)
+
+		byDistance = sorted(self._extendedData.iterkeys(), key = distance)
+		for day in byDistance[self.MAX_CACHED_DAYS:]:
+			del self._extendedData[day]
+
 	@misc_utils.log_exception(_moduleLogger)
-	def _on_success(self, data):
-		r = self._request
-		date = r[2]
-		self._request = None
-		try:
-			self._extendedData[date] = [
-				child
-				for child in data
-			]
-		except Exception, e:
-			_moduleLogger.exception("Translating error")
-			del self._extendedData[date]
-			r[1](e)
+	def _on_success(self, date, data, on_success, on_error):
+		if date not in self._extendedData:
+			try:
+				self._extendedData[date] = [
+					child
+					for child in data
+				]
+			except Exception, e:
+				_moduleLogger.exception("Translating error")
+				on_error(e)
+				return
+			programming = self._extendedData[date]
+			self._evict_programming()
 		else:
-			r[0](self._extendedData[date])
+			# Another request for the same day already stored it
+			programming = self._extendedData[date]
+		on_success(programming)
 
 	@misc_utils.log_exception(_moduleLogger)
-	def _on_error(self, error):
-		r = self._request
-		self._request = None
-		r[1](error)
+	def _on_prefetch_error(self, date, error):
+		self._prefetching.pop(date, None)
+		_moduleLogger.info("Could not prefetch programming for %s: %s" % (date, error))
 
 
 class ConferencesNode(ParentNode):
@@ -519,8 +942,28 @@ class ChapterNode(LeafNode):
 		return self._data["url"]
 
 
+def find_child_index(children, node):
+	"""
+	A node's id is its position among its parent's children, only fall back
+	to scanning in case children were rebuilt since node was handed out
+
+	@returns Index of node in children
+	"""
+	try:
+		i = node.id
+		if children[i] is node:
+			return i
+	except (TypeError, IndexError):
+		pass
+	for i, child in enumerate(children):
+		if child is node:
+			return i
+	raise RuntimeError("%r is not a child" % (node, ))
+
+
 def walk_ancestors(node):
-	while True:
+	# A parent that has been released ends the walk
+	while node is not None:
 		yield node
 		try:
 			node = node.get_parent()
@@ -550,37 +993,196 @@ def common_paths(targetNode, currentNode):
 	return ancestors, currentNode, descendants
 
 
+class _FanOut(object):
+
+	def __init__(self, nodes, on_node_success, on_node_error, on_done):
+		self._nodes = list(nodes)
+		self._on_node_success = on_node_success
+		self._on_node_error = on_node_error
+		self._on_done = on_done
+		self._pending = {}
+		self._handle = None
+
+	def start(self, handle, priority):
+		self._handle = handle
+		# Guard against every node completing before they've all been asked
+		self._pending[None] = None
+		for i, node in enumerate(self._nodes):
+			self._pending[i] = None
+			childHandle = node.get_children(
+				lambda children, i = i: self._on_success(i, children),
+				lambda error, i = i: self._on_error(i, error),
+				priority,
+			)
+			if i in self._pending:
+				self._pending[i] = childHandle
+		del self._pending[None]
+		self._check_done()
+
+	def cancel(self):
+		for childHandle in self._pending.values():
+			if childHandle is not None:
+				childHandle.cancel()
+		self._pending.clear()
+
+	@misc_utils.log_exception(_moduleLogger)
+	def _on_success(self, i, children):
+		if self._handle.is_cancelled:
+			return
+		del self._pending[i]
+		try:
+			self._on_node_success(self._nodes[i], children)
+		finally:
+			self._check_done()
+
+	@misc_utils.log_exception(_moduleLogger)
+	def _on_error(self, i, error):
+		if self._handle.is_cancelled:
+			return
+		del self._pending[i]
+		try:
+			self._on_node_error(self._nodes[i], error)
+		finally:
+			self._check_done()
+
+	def _check_done(self):
+		if self._pending or self._handle.is_finished:
+			return
+		self._handle.finish()
+		if self._on_done is not None:
+			self._on_done()
+
+
+class _Crawler(object):
+	"""
+	Fetch the children of every node under root at prefetch priority
+	"""
+
+	def __init__(self, root):
+		self._root = root
+		self._pending = {}
+		self._count = 0
+		self._errors = 0
+		self._on_done = None
+		self._isCancelled = False
+
+	def start(self, on_done):
+		"""
+		@param on_done: Called with the number of nodes crawled and the
+			number that failed to load and were skipped
+		"""
+		assert self._on_done is None
+		self._on_done = on_done
+		self._visit(self._root)
+		self._check_done()
+
+	def cancel(self):
+		self._isCancelled = True
+		for handle in self._pending.values():
+			if handle is not None:
+				handle.cancel()
+		self._pending.clear()
+
+	def _visit(self, node):
+		if node.is_leaf():
+			return
+		key = id(node)
+		self._pending[key] = None
+		handle = node.get_children(
+			lambda children: self._on_children(key, children),
+			lambda error: self._on_error(key, node, error),
+			go_utils.PRIORITY_PREFETCH,
+		)
+		if key in self._pending:
+			self._pending[key] = handle
+
+	@misc_utils.log_exception(_moduleLogger)
+	def _on_children(self, key, children):
+		if self._isCancelled:
+			return
+		self._count += 1
+		for child in children:
+			self._visit(child)
+		# Only now so children that complete immediately can't finish the crawl early
+		del self._pending[key]
+		self._check_done()
+
+	@misc_utils.log_exception(_moduleLogger)
+	def _on_error(self, key, node, error):
+		if self._isCancelled:
+			return
+		del self._pending[key]
+		self._errors += 1
+		_moduleLogger.info("Skipping %r while crawling: %s" % (node, error))
+		self._check_done()
+
+	def _check_done(self):
+		if self._pending or self._on_done is None:
+			return
+		on_done = self._on_done
+		self._on_done = None
+		on_done(self._count, self._errors)
+
+
 class AsyncWalker(object):
 
-	def __init__(self, func):
+	def __init__(self, func, priority = go_utils.PRIORITY_INTERACTIVE):
 		self._func = func
+		self._priority = priority
 		self._run = None
+		self._handle = None
+		self._isCancelled = False
 
 	def start(self, *args, **kwds):
 		assert self._run is None
 		self._run = self._func(*args, **kwds)
 		node = self._run.send(None) # priming the function
-		node.get_children(self.on_success, self.on_error)
+		self._request_children(node)
+
+	def cancel(self):
+		"""
+		Stop walking, neither of the callbacks passed to func will be called
+		"""
+		if self._isCancelled:
+			return
+		self._isCancelled = True
+		if self._handle is not None:
+			self._handle.cancel()
+			self._handle = None
+
+	@property
+	def is_cancelled(self):
+		return self._isCancelled
+
+	def _request_children(self, node):
+		self._handle = None
+		handle = node.get_children(self.on_success, self.on_error, self._priority)
+		if handle is not None and not handle.is_finished:
+			self._handle = handle
 
 	@misc_utils.log_exception(_moduleLogger)
 	def on_success(self, children):
+		if self._isCancelled:
+			return
 		_moduleLogger.debug("Processing success for: %r", self._func)
 		try:
 			node = self._run.send(children)
 		except StopIteration, e:
 			pass
 		else:
-			node.get_children(self.on_success, self.on_error)
+			self._request_children(node)
 
 	@misc_utils.log_exception(_moduleLogger)
 	def on_error(self, error):
+		if self._isCancelled:
+			return
 		_moduleLogger.debug("Processing error for: %r", self._func)
 		try:
 			node = self._run.throw(error)
 		except StopIteration, e:
 			pass
 		else:
-			node.get_children(self.on_success, self.on_error)
+			self._request_children(node)
 
 
 def get_next(node, on_success, on_error):
@@ -592,9 +1194,7 @@ def get_next(node, on_success, on_error):
 		while True:
 			parent = childNode.get_parent()
 			siblings = yield parent
-			for i, sibling in enumerate(siblings):
-				if sibling is childNode:
-					break
+			i = find_child_index(siblings, childNode)
 			i += 1
 			if i < len(siblings):
 				sibling = siblings[i]
@@ -625,9 +1225,7 @@ def get_previous(node, on_success, on_error):
 		while True:
 			parent = childNode.get_parent()
 			siblings = yield parent
-			for i, sibling in enumerate(siblings):
-				if sibling is childNode:
-					break
+			i = find_child_index(siblings, childNode)
 			i -= 1
 			if 0 <= i:
 				sibling = siblings[i]
@@ -647,3 +1245,8 @@ def get_previous(node, on_success, on_error):
 		raise RuntimeError("Ran out of nodes when hunting for first leaf of %s" % node)
 	except Exception, e:
 		on_error(e)
+
+
+if __name__ == "__main__":
+	import doctest
+	doctest.testmod()
@@ -3,6 +3,9 @@
 from __future__ import with_statement
 
 import time
+import heapq
+import itertools
+import collections
 import functools
 import threading
 import Queue
@@ -138,35 +141,179 @@ class Timeout(object):
 _QUEUE_EMPTY = object()
 
 
+# Lower runs first
+PRIORITY_SHUTDOWN = -1
+PRIORITY_INTERACTIVE = 0
+PRIORITY_THUMBNAIL = 10
+PRIORITY_PREFETCH = 20
+
+
+class TaskHandle(object):
+	"""
+	Returned to whoever queued a task so they can take it back.  A cancelled
+	task is skipped if it hasn't run yet and its callbacks are never called
+	"""
+
+	def __init__(self, on_cancel = None):
+		self._lock = threading.Lock()
+		self._isCancelled = False
+		self._isStarted = False
+		self._isFinished = False
+		self._on_cancel = on_cancel
+
+	def cancel(self):
+		with self._lock:
+			if self._isCancelled or self._isFinished:
+				return
+			self._isCancelled = True
+		if self._on_cancel is not None:
+			self._on_cancel()
+
+	def withdraw(self):
+		"""
+		Cancel the task only if no worker has picked it up yet
+
+		@returns True when the task was cancelled
+		"""
+		with self._lock:
+			if self._isCancelled or self._isStarted or self._isFinished:
+				return False
+			self._isCancelled = True
+		if self._on_cancel is not None:
+			self._on_cancel()
+		return True
+
+	def start(self):
+		"""
+		Mark the task as picked up by a worker
+
+		@returns False when it was cancelled first and must be skipped
+		"""
+		with self._lock:
+			if self._isCancelled:
+				return False
+			self._isStarted = True
+			return True
+
+	@property
+	def is_cancelled(self):
+		return self._isCancelled
+
+	@property
+	def is_started(self):
+		return self._isStarted
+
+	@property
+	def is_finished(self):
+		return self._isFinished
+
+	def finish(self):
+		"""
+		Mark the task as having delivered its result, cancelling is then a no-op
+		"""
+		self._isFinished = True
+
+
+class _PriorityQueue(Queue.Queue):
+	"""
+	Heap backed queue, pulling out the smallest item first (Queue.PriorityQueue
+	isn't available until python 2.6)
+	"""
+
+	def _init(self, maxsize):
+		self.queue = []
+
+	def _qsize(self, len = len):
+		return len(self.queue)
+
+	def _put(self, item):
+		heapq.heappush(self.queue, item)
+
+	def _get(self):
+		return heapq.heappop(self.queue)
+
+
 class AsyncPool(object):
 
-	def __init__(self):
-		self.__workQueue = Queue.Queue()
-		self.__thread = threading.Thread(
-			name = type(self).__name__,
-			target = self.__consume_queue,
-		)
+	# Seconds of callbacks to run per main loop dispatch before yielding
+	DISPATCH_SLICE = 0.05
+
+	def __init__(self, workers = 1):
+		"""
+		@param workers: Number of threads running tasks concurrently
+		"""
+		assert 0 < workers
+		self.__workQueue = _PriorityQueue()
+		self.__completed = collections.deque()
+		self.__completedLock = threading.Lock()
+		self.__isDispatchScheduled = False
+		self.__sequence = itertools.count()
+		self.__threads = [
+			threading.Thread(
+				name = "%s-%d" % (type(self).__name__, i),
+				target = self.__consume_queue,
+			)
+			for i in xrange(workers)
+		]
 		self.__isRunning = True
 
 	def start(self):
-		self.__thread.start()
+		for thread in self.__threads:
+			thread.start()
 
-	def stop(self):
+	def stop(self, timeout = None):
+		"""
+		Drop queued tasks and wait for the workers to finish what they are
+		running
+
+		@param timeout: Seconds to wait on each worker, None to wait it out
+		"""
 		self.__isRunning = False
 		for _ in algorithms.itr_available(self.__workQueue):
 			pass # eat up queue to cut down dumb work
-		self.__workQueue.put(_QUEUE_EMPTY)
+		for _ in self.__threads:
+			self.__workQueue.put((PRIORITY_SHUTDOWN, self.__sequence.next(), _QUEUE_EMPTY))
+		for thread in self.__threads:
+			if thread.isAlive() and thread is not threading.currentThread():
+				thread.join(timeout)
 
 	def clear_tasks(self):
 		for _ in algorithms.itr_available(self.__workQueue):
 			pass # eat up queue to cut down dumb work
 
-	def add_task(self, func, args, kwds, on_success, on_error):
-		task = func, args, kwds, on_success, on_error
-		self.__workQueue.put(task)
+	def add_task(self, func, args, kwds, on_success, on_error, priority = PRIORITY_INTERACTIVE):
+		"""
+		@param priority: One of the PRIORITY_* levels, tasks of the same
+			priority run in the order they were added
+		@returns TaskHandle for cancelling the task
+		"""
+		handle = TaskHandle()
+		task = func, args, kwds, on_success, on_error, handle
+		self.__workQueue.put((priority, self.__sequence.next(), task))
+		return handle
 
 	@misc.log_exception(_moduleLogger)
-	def __trampoline_callback(self, on_success, on_error, isError, result):
+	def __on_dispatch_completed(self):
+		"""
+		Run the callbacks of finished tasks in one idle source rather than one
+		source per task, yielding back to the main loop once the time slice
+		is used up
+		"""
+		deadline = time.time() + self.DISPATCH_SLICE
+		while True:
+			with self.__completedLock:
+				if not self.__completed:
+					self.__isDispatchScheduled = False
+					return False
+				completion = self.__completed.popleft()
+			self.__trampoline_callback(*completion)
+			if deadline <= time.time():
+				return True
+
+	def __trampoline_callback(self, on_success, on_error, handle, isError, result):
+		if handle.is_cancelled:
+			return
+		handle.finish()
 		if not self.__isRunning:
 			if isError:
 				_moduleLogger.error("Masking: %s" % (result, ))
@@ -177,15 +324,25 @@ class AsyncPool(object):
 			callback(result)
 		except Exception:
 			_moduleLogger.exception("Callback errored")
-		return False
+
+	def __complete(self, *completion):
+		with self.__completedLock:
+			self.__completed.append(completion)
+			if self.__isDispatchScheduled:
+				return
+			self.__isDispatchScheduled = True
+		gobject.idle_add(self.__on_dispatch_completed)
 
 	@misc.log_exception(_moduleLogger)
 	def __consume_queue(self):
 		while True:
-			task = self.__workQueue.get()
+			priority, sequence, task = self.__workQueue.get()
 			if task is _QUEUE_EMPTY:
 				break
-			func, args, kwds, on_success, on_error = task
+			func, args, kwds, on_success, on_error, handle = task
+			if not handle.start():
+				self.__workQueue.task_done()
+				continue
 
 			try:
 				result = func(*args, **kwds)
@@ -196,7 +353,7 @@ class AsyncPool(object):
 				isError = True
 			self.__workQueue.task_done()
 
-			gobject.idle_add(self.__trampoline_callback, on_success, on_error, isError, result)
+			self.__complete(on_success, on_error, handle, isError, result)
 		_moduleLogger.debug("Shutting down worker thread")
 
 
@@ -256,18 +413,36 @@ class AutoSignal(object):
 
 	def __init__(self, toplevel):
 		self.__disconnectPool = []
+		self.__cancelPool = []
 		toplevel.connect("destroy", self.__on_destroy)
 
 	def connect_auto(self, widget, *args):
 		id = widget.connect(*args)
 		self.__disconnectPool.append((widget, id))
 
+	def cancel_auto(self, handle):
+		"""
+		Cancel a TaskHandle when the toplevel is destroyed, None is ignored
+		for requests that completed immediately
+		"""
+		if handle is None or handle.is_finished:
+			return
+		self.__cancelPool[:] = [
+			pending
+			for pending in self.__cancelPool
+			if not pending.is_finished
+		]
+		self.__cancelPool.append(handle)
+
 	@misc.log_exception(_moduleLogger)
 	def __on_destroy(self, widget):
 		_moduleLogger.info("Destroy: %r (%s to clean up)" % (self, len(self.__disconnectPool)))
 		for widget, id in self.__disconnectPool:
 			widget.disconnect(id)
 		del self.__disconnectPool[:]
+		for handle in self.__cancelPool:
+			handle.cancel()
+		del self.__cancelPool[:]
 
 
 def throttled(minDelay, queue):
@@ -4,16 +4,30 @@
 from __future__ import with_statement
 
 import os
+import time
+import errno
+import tempfile
 import pickle
 import contextlib
 import itertools
 import codecs
 import csv
+import logging
 try:
 	import cStringIO as StringIO
 except ImportError:
 	import StringIO
 
+try:
+	import hashlib
+	md5 = hashlib.md5
+except ImportError:
+	import md5 as _md5
+	md5 = _md5.new
+
+
+_moduleLogger = logging.getLogger(__name__)
+
 
 @contextlib.contextmanager
 def change_directory(directory):
@@ -27,6 +41,91 @@ def change_directory(directory):
 		os.chdir(previousDirectory)
 
 
+def makedirs(path):
+	"""
+	Like os.makedirs but fine with the directory already existing
+	"""
+	try:
+		os.makedirs(path)
+	except OSError, e:
+		if e.errno != errno.EEXIST:
+			raise
+
+
+class AtomicFile(object):
+	"""
+	Written under a temporary name next to path and only moved into place on
+	commit, so readers see either the old contents or all of the new
+	"""
+
+	def __init__(self, path, prefix = "tmp"):
+		self._path = path
+		fd, self._tempPath = tempfile.mkstemp(dir=os.path.dirname(path), prefix=prefix)
+		self._f = os.fdopen(fd, "wb")
+
+	def write(self, data):
+		self._f.write(data)
+
+	def commit(self):
+		if self._f is None:
+			return
+		f, self._f = self._f, None
+		try:
+			f.close()
+			os.rename(self._tempPath, self._path)
+		except (OSError, IOError):
+			self._remove_temp()
+			raise
+
+	def abort(self):
+		if self._f is None:
+			return
+		f, self._f = self._f, None
+		try:
+			f.close()
+		except IOError:
+			pass
+		self._remove_temp()
+
+	def _remove_temp(self):
+		try:
+			os.remove(self._tempPath)
+		except OSError:
+			pass
+
+
+def purge_older_than(path, maxAge):
+	"""
+	Remove the files in the directory path not modified in maxAge seconds
+
+	@returns Number of files removed
+	"""
+	cutoff = time.time() - maxAge
+	removed = 0
+	for filename in os.listdir(path):
+		filePath = os.path.join(path, filename)
+		try:
+			if os.path.getmtime(filePath) < cutoff:
+				os.remove(filePath)
+				removed += 1
+		except OSError:
+			_moduleLogger.exception("Could not purge %s" % filename)
+	return removed
+
+
+def write_atomically(path, data, prefix = "tmp"):
+	"""
+	Replace the contents of path with data, see AtomicFile
+	"""
+	f = AtomicFile(path, prefix)
+	try:
+		f.write(data)
+	except (OSError, IOError):
+		f.abort()
+		raise
+	f.commit()
+
+
 @contextlib.contextmanager
 def pickled(filename):
 	"""
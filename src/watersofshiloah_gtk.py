@@ -48,7 +48,10 @@ class WatersOfShiloahProgram(hildonize.get_app_class()):
 			if os.path.isdir(storePath):
 				break
 		self._store = imagestore.ImageStore(storePath, constants._cache_path_)
-		self._index = stream_index.AudioIndex()
+		self._index = stream_index.AudioIndex(
+			os.path.join(constants._cache_path_, "api"),
+			os.path.join(constants._data_path_, "index.snapshot"),
+		)
 		self._player = player.Player(self._index)
 
 		self._store.start()
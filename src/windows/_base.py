@@ -58,6 +58,7 @@ class BasicWindow(gobject.GObject, go_utils.AutoSignal):
 	def __init__(self, app, player, store):
 		gobject.GObject.__init__(self)
 		self._isDestroyed = False
+		self._pinnedNodes = []
 		self._isPortrait = hildonize.IS_FREMANTLE_SUPPORTED
 
 		self._app = app
@@ -114,6 +115,13 @@ class BasicWindow(gobject.GObject, go_utils.AutoSignal):
 	def window(self):
 		return self._window
 
+	def _pin_node(self, node):
+		"""
+		Keep node's path loaded for as long as the window is open
+		"""
+		node.pin()
+		self._pinnedNodes.append(node)
+
 	def show(self):
 		if self._isPortrait:
 			hildonize.window_to_portrait(self._window)
@@ -187,6 +195,9 @@ class BasicWindow(gobject.GObject, go_utils.AutoSignal):
 	@misc_utils.log_exception(_moduleLogger)
 	def _on_destroy(self, *args):
 		self._isDestroyed = True
+		for node in self._pinnedNodes:
+			node.unpin()
+		del self._pinnedNodes[:]
 
 	@misc_utils.log_exception(_moduleLogger)
 	def _on_window_state_change(self, widget, event, *args):
@@ -270,6 +281,7 @@ class ListWindow(BasicWindow):
 	def __init__(self, app, player, store, node):
 		BasicWindow.__init__(self, app, player, store)
 		self._node = node
+		self._pin_node(self._node)
 
 		self.connect_auto(self._player, "title-change", self._on_player_title_change)
 
@@ -329,8 +341,18 @@ class ListWindow(BasicWindow):
 		if not descendants:
 			return -1
 		activeChild = descendants[0]
+		return self._find_row(activeChild)
+
+	def _find_row(self, node):
+		"""
+		@returns Index of the row for node or -1
+		"""
+		# Rows are added in child order so the node's id is normally its row
+		i = node.id
+		if isinstance(i, int) and 0 <= i < len(self._model) and self._model[i][0] is node:
+			return i
 		for i, row in enumerate(self._model):
-			if activeChild is row[0]:
+			if node is row[0]:
 				return i
 		else:
 			return -1
@@ -426,6 +448,7 @@ class PresenterWindow(BasicWindow):
 	def __init__(self, app, player, store, node):
 		BasicWindow.__init__(self, app, player, store)
 		self._node = node
+		self._pin_node(self._node)
 		self._playerNode = self._player.node
 		self._nextSearch = None
 		self._updateSeek = None
@@ -42,10 +42,10 @@ class ConferencesWindow(windows._base.ListWindow):
 
 	def _refresh(self):
 		windows._base.ListWindow._refresh(self)
-		self._node.get_children(
+		self.cancel_auto(self._node.get_children(
 			self._on_conferences,
 			self._on_error,
-		)
+		))
 
 	@misc_utils.log_exception(_moduleLogger)
 	def _on_conferences(self, programs):
@@ -97,10 +97,10 @@ class ConferenceSessionsWindow(windows._base.ListWindow):
 
 	def _refresh(self):
 		windows._base.ListWindow._refresh(self)
-		self._node.get_children(
+		self.cancel_auto(self._node.get_children(
 			self._on_conference_sessions,
 			self._on_error,
-		)
+		))
 
 	@misc_utils.log_exception(_moduleLogger)
 	def _on_conference_sessions(self, programs):
@@ -151,10 +151,10 @@ class ConferenceTalksWindow(windows._base.ListWindow):
 
 	def _refresh(self):
 		windows._base.ListWindow._refresh(self)
-		self._node.get_children(
+		self.cancel_auto(self._node.get_children(
 			self._on_conference_talks,
 			self._on_error,
-		)
+		))
 
 	@misc_utils.log_exception(_moduleLogger)
 	def _on_conference_talks(self, programs):
@@ -6,6 +6,7 @@ import gtk
 import hildonize
 import util.go_utils as go_utils
 import util.misc as misc_utils
+import stream_index
 
 import windows
 
@@ -13,6 +14,9 @@ import windows
 _moduleLogger = logging.getLogger(__name__)
 
 
+COVER_SIZE = 96
+
+
 class MagazinesWindow(windows._base.ListWindow):
 
 	def __init__(self, app, player, store, node):
@@ -26,7 +30,7 @@ class MagazinesWindow(windows._base.ListWindow):
 		pixrenderer = gtk.CellRendererPixbuf()
 		column = gtk.TreeViewColumn("Covers")
 		column.set_property("sizing", gtk.TREE_VIEW_COLUMN_FIXED)
-		column.set_property("fixed-width", 96)
+		column.set_property("fixed-width", COVER_SIZE)
 		column.pack_start(pixrenderer, expand=True)
 		column.add_attribute(pixrenderer, "pixbuf", 1)
 		yield gobject.TYPE_OBJECT, column
@@ -41,10 +45,10 @@ class MagazinesWindow(windows._base.ListWindow):
 
 	def _refresh(self):
 		windows._base.ListWindow._refresh(self)
-		self._node.get_children(
+		self.cancel_auto(self._node.get_children(
 			self._on_magazines,
 			self._on_error,
-		)
+		))
 
 	@misc_utils.log_exception(_moduleLogger)
 	def _on_magazines(self, programs):
@@ -53,28 +57,36 @@ class MagazinesWindow(windows._base.ListWindow):
 			return
 
 		self._hide_loading()
-		for i, programNode in enumerate(programs):
+		for programNode in programs:
 			program = programNode.get_properties()
 			img = self._store.get_pixbuf_from_store(self._store.STORE_LOOKUP["nomagazineimage"])
 			row = programNode, img, program["title"]
 			self._model.append(row)
 
-			programNode.get_children(self._create_on_issues(i), self._on_error)
+		self.cancel_auto(stream_index.ParentNode.get_children_of(
+			programs,
+			self._on_issues,
+			lambda programNode, e: self._on_error(e),
+			priority = go_utils.PRIORITY_THUMBNAIL,
+		))
 
 		self._select_row()
 		go_utils.Async(self._on_delay_scroll).start()
 
-	def _create_on_issues(self, row):
-		return lambda issues: self._on_issues(row, issues)
-
 	@misc_utils.log_exception(_moduleLogger)
-	def _on_issues(self, row, issues):
+	def _on_issues(self, programNode, issues):
+		if self._isDestroyed:
+			return
+		row = self._find_row(programNode)
+		if row < 0:
+			return
 		for issue in issues:
-			self._store.get_pixbuf_from_url(
+			self.cancel_auto(self._store.get_pixbuf_from_url(
 				issue.get_properties()["pictureURL"],
 				lambda pix: self._on_image(row, pix),
 				self._on_error,
-			)
+				COVER_SIZE,
+			))
 			break
 		else:
 			_moduleLogger.info("No issues for magazine %s" % row)
@@ -114,7 +126,7 @@ class MagazineIssuesWindow(windows._base.ListWindow):
 		pixrenderer = gtk.CellRendererPixbuf()
 		column = gtk.TreeViewColumn("Covers")
 		column.set_property("sizing", gtk.TREE_VIEW_COLUMN_FIXED)
-		column.set_property("fixed-width", 96)
+		column.set_property("fixed-width", COVER_SIZE)
 		column.pack_start(pixrenderer, expand=True)
 		column.add_attribute(pixrenderer, "pixbuf", 1)
 		yield gobject.TYPE_OBJECT, column
@@ -129,10 +141,10 @@ class MagazineIssuesWindow(windows._base.ListWindow):
 
 	def _refresh(self):
 		windows._base.ListWindow._refresh(self)
-		self._node.get_children(
+		self.cancel_auto(self._node.get_children(
 			self._on_magazine_issues,
 			self._on_error,
-		)
+		))
 
 	@misc_utils.log_exception(_moduleLogger)
 	def _on_magazine_issues(self, programs):
@@ -147,11 +159,12 @@ class MagazineIssuesWindow(windows._base.ListWindow):
 			row = programNode, img, program["title"]
 			self._model.append(row)
 
-			self._store.get_pixbuf_from_url(
+			self.cancel_auto(self._store.get_pixbuf_from_url(
 				program["pictureURL"],
 				self._create_on_image(programNode),
 				self._on_error,
-			)
+				COVER_SIZE,
+			))
 
 		self._select_row()
 		go_utils.Async(self._on_delay_scroll).start()
@@ -166,10 +179,8 @@ class MagazineIssuesWindow(windows._base.ListWindow):
 
 	@misc_utils.log_exception(_moduleLogger)
 	def _on_image(self, childNode, pix):
-		for i, row in enumerate(self._model):
-			if row[0] is childNode:
-				break
-		else:
+		i = self._find_row(childNode)
+		if i < 0:
 			raise RuntimeError("Could not find %r" % childNode)
 		treeiter = self._model.iter_nth_child(None, i)
 		self._model.set_value(treeiter, 1, pix)
@@ -205,10 +216,10 @@ class MagazineArticlesWindow(windows._base.ListWindow):
 
 	def _refresh(self):
 		windows._base.ListWindow._refresh(self)
-		self._node.get_children(
+		self.cancel_auto(self._node.get_children(
 			self._on_magazine_articles,
 			self._on_error,
-		)
+		))
 
 	@misc_utils.log_exception(_moduleLogger)
 	def _on_magazine_articles(self, programs):
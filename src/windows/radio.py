@@ -23,6 +23,10 @@ class RadioWindow(windows._base.BasicWindow):
 		windows._base.BasicWindow.__init__(self, app, player, store)
 		self._node = node
 		self._childNode = None
+		# Requests of the last refresh, a newer one makes them pointless
+		self._refreshRequests = []
+		# Keep the channel, along with the days of programming it holds
+		self._pin_node(self._node)
 
 		self.connect_auto(self._player, "state-change", self._on_player_state_change)
 		self.connect_auto(self._player, "title-change", self._on_player_title_change)
@@ -137,12 +141,21 @@ class RadioWindow(windows._base.BasicWindow):
 	def _refresh(self):
 		self._show_loading()
 		self._programmingModel.clear()
-		self._node.get_children(
+		for handle in self._refreshRequests:
+			handle.cancel()
+		del self._refreshRequests[:]
+		self._track_refresh(self._node.get_children(
 			self._on_channels,
 			self._on_load_error,
-		)
+		))
 		self._set_context(self._player.state)
 
+	def _track_refresh(self, handle):
+		if handle is None:
+			return
+		self._refreshRequests.append(handle)
+		self.cancel_auto(handle)
+
 	def _get_current_row(self):
 		nowTime = self._dateShown.strftime("%H:%M:%S")
 		i = 0
@@ -250,22 +263,26 @@ class RadioWindow(windows._base.BasicWindow):
 		if 1 < len(channels):
 			_moduleLogger.warning("More channels now available!")
 		self._childNode = channels[0]
-		self._childNode.get_programming(
+		self._track_refresh(self._childNode.get_programming(
 			self._dateShown,
-			self._on_channel,
+			lambda programs, date=self._dateShown: self._on_channel(date, programs),
 			self._on_load_error,
-		)
+		))
 
 	@misc_utils.log_exception(_moduleLogger)
-	def _on_channel(self, programs):
+	def _on_channel(self, date, programs):
 		if self._isDestroyed:
 			_moduleLogger.info("Download complete but window destroyed")
 			return
+		if date.date() != self._dateShown.date():
+			_moduleLogger.info("Dropping programming for %s, no longer shown" % date.date())
+			return
 
 		self._hide_loading()
 		for program in programs:
 			row = program["time"], program["title"]
 			self._programmingModel.append(row)
+		self._childNode.prefetch_programming(self._dateShown)
 
 		currentDate = self._currentTime
 		if currentDate.date() != self._dateShown.date():
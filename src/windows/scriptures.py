@@ -33,10 +33,10 @@ class ScripturesWindow(windows._base.ListWindow):
 
 	def _refresh(self):
 		windows._base.ListWindow._refresh(self)
-		self._node.get_children(
+		self.cancel_auto(self._node.get_children(
 			self._on_scriptures,
 			self._on_error,
-		)
+		))
 
 	@misc_utils.log_exception(_moduleLogger)
 	def _on_scriptures(self, programs):
@@ -88,10 +88,10 @@ class ScriptureBooksWindow(windows._base.ListWindow):
 
 	def _refresh(self):
 		windows._base.ListWindow._refresh(self)
-		self._node.get_children(
+		self.cancel_auto(self._node.get_children(
 			self._on_scripture_books,
 			self._on_error,
-		)
+		))
 
 	@misc_utils.log_exception(_moduleLogger)
 	def _on_scripture_books(self, programs):
@@ -143,10 +143,10 @@ class ScriptureChaptersWindow(windows._base.ListWindow):
 
 	def _refresh(self):
 		windows._base.ListWindow._refresh(self)
-		self._node.get_children(
+		self.cancel_auto(self._node.get_children(
 			self._on_scripture_chapters,
 			self._on_error,
-		)
+		))
 
 	@misc_utils.log_exception(_moduleLogger)
 	def _on_scripture_chapters(self, programs):
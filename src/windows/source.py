@@ -97,6 +97,13 @@ class SourceSelector(windows._base.BasicWindow):
 	def _on_languages(self, languages):
 		self._hide_loading()
 		self._languages = list(languages)
+		for source in (
+			stream_index.SOURCE_RADIO,
+			stream_index.SOURCE_CONFERENCES,
+			stream_index.SOURCE_MAGAZINES,
+			stream_index.SOURCE_SCRIPTURES,
+		):
+			self._index.crawl_source(source, self._languages[0]["id"])
 		if self._selectedNode:
 			self._show_window_by_node_name(self._selectedNode)
 			self._selectedNode = ""
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+
+"""
+Pack small UI images into one atlas image plus a map of where each landed, so
+the application decodes a single file instead of one per image
+"""
+
+import os
+
+import gtk
+
+
+verbose = False
+
+
+def pack(sizes, width):
+	"""
+	Shelf packing, tallest first
+
+	>>> pack([("a", 10, 10), ("b", 10, 5), ("c", 15, 5)], 20)
+	(20, 15, [('a', 0, 0, 10, 10), ('b', 10, 0, 10, 5), ('c', 0, 10, 15, 5)])
+	"""
+	placements = []
+	x, y, shelfHeight = 0, 0, 0
+	for name, w, h in sorted(sizes, key=lambda size: -size[2]):
+		assert w <= width, "%s is wider than the atlas" % name
+		if width < x + w:
+			x, y, shelfHeight = 0, y + shelfHeight, 0
+		placements.append((name, x, y, w, h))
+		x += w
+		shelfHeight = max(shelfHeight, h)
+	return width, y + shelfHeight, placements
+
+
+def build_atlas(imagePaths, atlasPath, mapPath, width):
+	pixbufs = {}
+	for path in imagePaths:
+		pixbuf = gtk.gdk.pixbuf_new_from_file(path)
+		if not pixbuf.get_has_alpha():
+			pixbuf = pixbuf.add_alpha(False, 0, 0, 0)
+		pixbufs[os.path.basename(path)] = pixbuf
+
+	atlasWidth, atlasHeight, placements = pack(
+		[
+			(name, pixbuf.get_width(), pixbuf.get_height())
+			for (name, pixbuf) in pixbufs.iteritems()
+		],
+		width,
+	)
+
+	atlas = gtk.gdk.Pixbuf(gtk.gdk.COLORSPACE_RGB, True, 8, atlasWidth, atlasHeight)
+	atlas.fill(0x00000000)
+	for name, x, y, w, h in placements:
+		pixbufs[name].copy_area(0, 0, w, h, atlas, x, y)
+		if verbose:
+			print "%s at %d,%d (%dx%d)" % (name, x, y, w, h)
+	atlas.save(atlasPath, "png")
+
+	mapFile = open(mapPath, "w")
+	try:
+		mapFile.write("# name x y width height\n")
+		for placement in sorted(placements):
+			mapFile.write("%s %d %d %d %d\n" % placement)
+	finally:
+		mapFile.close()
+
+
+if __name__ == "__main__":
+	import sys
+	import optparse
+
+	opar = optparse.OptionParser(usage="%prog [options] ATLAS MAP IMAGE...")
+	opar.add_option("-v", "--verbose", dest="verbose", help="Toggle verbosity", action="store_true", default=False)
+	opar.add_option("-w", "--width", dest="width", help="Width of the atlas in pixels", type="int", default=256)
+	options, args = opar.parse_args(sys.argv[1:])
+	verbose = options.verbose
+	if len(args) < 3:
+		opar.error("Need the atlas, map and at least one image")
+
+	build_atlas(args[2:], args[0], args[1], options.width)